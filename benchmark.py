@@ -0,0 +1,124 @@
+"""Benchmark each stage of the pipeline on synthetic manuscripts of increasing size.
+Each scale is run in a fresh process, on folders generated by synthetic.py, and every stage is timed; results can be saved as JSON and compared with an earlier run, e.g. of another commit.
+"""
+import os
+import json
+import time
+import resource
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import entry
+import manuscript
+import synthetic
+
+def timed(results, stage, func, repeat=1):
+    """Run `func` `repeat` times, recording the best time of `stage` in `results`, and return the result of the last run."""
+    best = None
+    for _ in range(repeat):
+        entry.render_cache.clear() # so each run renders from scratch
+        start = time.perf_counter()
+        value = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results.append({"stage": stage, "seconds": round(best, 6)})
+    return value
+
+def run_scale(scale, repeat=1, workdir=None):
+    """Generate a synthetic manuscript at the given scale and time each stage on it. Returns a dictionary of results."""
+    results = []
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        source = os.path.join(tmp, "ms-xml")
+        out = os.path.join(tmp, "out")
+        directories = timed(results, "generate", lambda: synthetic.generate(source, scale=scale))
+
+        ms = timed(results, "from_dirs", lambda: manuscript.Manuscript.from_dirs(*directories), repeat) # fields are not computed yet
+        n_entries = sum(len(es) for es in ms.entries.values())
+        n_folios = sum(len(fs) for fs in ms.folios.values())
+        timed(results, "render fields", ms.precompute) # so the following stages only measure their own work
+        timed(results, "generate_metadata", ms.generate_metadata, repeat)
+        timed(results, "generate_all_folios", lambda: [ms.generate_all_folios(method, version) for version in ms.versions for method in ("txt", "xml")], repeat)
+
+        timed(results, "update_metadata", lambda: ms.update_metadata(outdir=os.path.join(out, "metadata")))
+        timed(results, "update_ms_txt", lambda: ms.update_ms_txt(outdir=os.path.join(out, "ms-txt")))
+        timed(results, "update_entries", lambda: ms.update_entries(outdir=os.path.join(out, "entries")))
+        timed(results, "update_all_folios", lambda: ms.update_all_folios(outdir=os.path.join(out, "allFolios")))
+        timed(results, "update (incremental, unchanged)", lambda: [
+            ms.update_metadata(outdir=os.path.join(out, "metadata"), incremental=True),
+            ms.update_ms_txt(outdir=os.path.join(out, "ms-txt"), incremental=True),
+            ms.update_entries(outdir=os.path.join(out, "entries"), incremental=True),
+            ms.update_all_folios(outdir=os.path.join(out, "allFolios"), incremental=True),
+        ], repeat)
+
+        del ms # so peak memory reflects a single manuscript
+        cache = os.path.join(tmp, "cache", "manuscript.pickle")
+        timed(results, "load_cached (cold)", lambda: manuscript.Manuscript.load_cached(*directories, path=cache))
+        timed(results, "load_cached (warm)", lambda: manuscript.Manuscript.load_cached(*directories, path=cache), repeat)
+
+    return {
+        "scale": scale,
+        "entries": n_entries,
+        "folios": n_folios,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), # ru_maxrss is in kilobytes on Linux
+        "stages": results,
+    }
+
+def git_commit():
+    """Return the current commit of this repository, or None if it cannot be found."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(run, baseline=None):
+    """Print a table of the time of each stage at each scale, and the ratio to the same stage in `baseline` if given."""
+    previous = {}
+    if baseline:
+        previous = {(r["scale"], s["stage"]): s["seconds"] for r in baseline["results"] for s in r["stages"]}
+        print(f"Compared with {baseline.get('commit') or 'baseline'} ({baseline.get('date')}):")
+    for result in run["results"]:
+        print(f"scale {result['scale']}x: {result['entries']} entries, {result['folios']} folios, peak {result['max_rss_mb']} MB")
+        for stage in result["stages"]:
+            line = f"  {stage['stage']:<34} {stage['seconds']:>10.3f}s"
+            before = previous.get((result["scale"], stage["stage"]))
+            if before:
+                line += f"  {stage['seconds'] / before:>6.2f}x"
+            print(line)
+
+def benchmark():
+    parser = argparse.ArgumentParser(description="Time each stage of the pipeline on synthetic manuscripts at several scales.")
+    parser.add_argument('-s', '--scales', type=float, nargs="+", default=[1, 10, 100], help="Sizes relative to the real manuscript. Defaults to 1 10 100.")
+    parser.add_argument('-n', '--repeat', type=int, default=1, help="Number of runs of the faster stages, of which the best time is kept. Defaults to 1.")
+    parser.add_argument('-o', '--output', help="JSON file to which to write the results.")
+    parser.add_argument('-c', '--compare', help="JSON file of earlier results, to print the ratio of each time to it.")
+    parser.add_argument('--workdir', help="Folder in which to generate the synthetic manuscripts. Defaults to the system's temporary folder.")
+    args = parser.parse_args()
+
+    run = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "renderer": entry.renderer,
+        "results": [],
+    }
+    for scale in args.scales:
+        with ProcessPoolExecutor(max_workers=1) as executor: # fresh process, so peak memory is measured per scale
+            run["results"].append(executor.submit(run_scale, scale, args.repeat, args.workdir).result())
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as fp:
+            baseline = json.load(fp)
+    print_results(run, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(run, fp, indent=1)
+
+if __name__ == "__main__":
+    benchmark()
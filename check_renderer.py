@@ -0,0 +1,77 @@
+"""Differential test of the native text renderer against annotations.xslt.
+Renders every folio, every entry, and every element of every folio in ms-xml with both backends and reports any difference.
+Exits with a non-zero status if the outputs differ anywhere.
+"""
+import os
+import sys
+import argparse
+import itertools
+from lxml import etree as et
+
+import entry
+import manuscript
+import utils
+
+def param_sets(exhaustive=False):
+    """Yield parameter dictionaries to test. By default: the defaults, plus each mode of each editorial tag on its own.
+    If `exhaustive`, every combination of modes.
+    """
+    if exhaustive:
+        tags = list(entry.editorial_modes.keys())
+        for modes in itertools.product(*entry.editorial_modes.values()):
+            yield {tag: f"'{mode}'" for tag, mode in zip(tags, modes)}
+    else:
+        yield {}
+        for tag, modes in entry.editorial_modes.items():
+            for mode in modes:
+                yield {tag: f"'{mode}'"}
+
+def compare(xml, params, label, mismatches):
+    """Render `xml` with both backends and record a mismatch if their outputs differ."""
+    expected = entry.xslt_transform(xml, entry.transform, params=params)
+    actual = entry.render(xml, params=params)
+    if expected != actual:
+        i = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual))) # first differing character
+        start = max(0, i - 40)
+        mismatches.append(f"{label} {params} at character {i}:\n  xslt:   {expected[start:i+40]!r}\n  native: {actual[start:i+40]!r}")
+
+def check_dir(directory, exhaustive=False):
+    """Compare both backends on every file in a version folder. Returns the number of comparisons and a list of mismatches."""
+    mismatches = []
+    n = 0
+    sources = manuscript.load_dir(directory)
+    for folio, tree in sources:
+        label = f"{os.path.basename(directory)} folio {folio}"
+        for params in param_sets(exhaustive):
+            compare(tree, params, label, mismatches)
+            n += 1
+        for element in tree.getroot().iter(tag=et.Element): # every element, as rendered for titles and property terms
+            for params in ({}, {"del": "'omit'"}):
+                compare(element, params, f"{label} {tree.getpath(element)}", mismatches)
+                n += 1
+    for e in manuscript.generate_entries(directory, sources):
+        for params in param_sets(exhaustive):
+            compare(e.xml, params, f"{os.path.basename(directory)} entry {e.identity}", mismatches)
+            n += 1
+    return n, mismatches
+
+def check_renderer():
+    parser = argparse.ArgumentParser(description="Check that the native renderer gives the same output as annotations.xslt across the whole manuscript.")
+    parser.add_argument('-x', '--exhaustive', help="Test every combination of editorial tag modes, not just one tag at a time.", action="store_true")
+    parser.add_argument("path", nargs="?", default=utils.manuscript_data_path, help="Path to m-k-manuscript-data directory. Defaults to the sibling of your current directory.")
+    args = parser.parse_args()
+
+    total, mismatches = 0, []
+    for version in utils.versions:
+        n, m = check_dir(os.path.join(args.path, "ms-xml", version), exhaustive=args.exhaustive)
+        total += n
+        mismatches += m
+
+    for mismatch in mismatches:
+        print(f"MISMATCH {mismatch}")
+    print(f"{total} renderings compared, {len(mismatches)} mismatched.")
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    check_renderer()
@@ -1,6 +1,12 @@
-from typing import List, Dict, OrderedDict
+from typing import List, Dict, Tuple, OrderedDict, Hashable
 from lxml import etree as et
+from functools import lru_cache
+import hashlib
+import re
+import unicodedata
+from types import MappingProxyType
 import utils
+from instrument import profiler
 
 # stylesheet to use for XSLT transformations
 transform = et.XSLT(et.parse(utils.stylesheet_path))
@@ -16,11 +22,88 @@ def to_xml_string(xml: et.Element) -> str:
     """Render an XML etree as decoded utf-8 text, with tags."""
     return et.tostring(xml, encoding="utf-8", pretty_print=False).decode()
 
-def to_string(xml: et.Element, params={}) -> str:
+# Editorial tags handled by annotations.xslt, with the text each one is wrapped in when rendered in "annotate" mode, and the modes each one accepts.
+editorial_tags = {
+    "corr": ("[", "]"),
+    "del": ("<-", "->"),
+    "exp": ("{", "}"),
+    "ill": ("[illegible]", ""),
+    "sup": ("[", "]"),
+}
+editorial_modes = {tag: ("annotate", "omit") if tag == "ill" else ("annotate", "plaintext", "omit") for tag in editorial_tags}
+
+# Backend used by to_string(): "native" for render(), or "xslt" for the annotations.xslt stylesheet. Both produce the same output.
+renderer = "native"
+
+class RenderCache:
+    """Bounded cache of rendered text which evicts the least recently used item when full, and counts hits and misses.
+    A `maxsize` of 0 disables caching.
+    """
+    def __init__(self, maxsize: int = 8192):
+        self.maxsize = maxsize
+        self.items: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> str:
+        """Return the cached text for `key`, or None if it is not cached."""
+        text = self.items.get(key)
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.items.move_to_end(key)
+        return text
+
+    def put(self, key: Hashable, text: str) -> None:
+        if self.maxsize <= 0:
+            return
+        self.items[key] = text
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def clear(self) -> None:
+        self.items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.items), "maxsize": self.maxsize}
+
+# cache used by to_string()
+render_cache = RenderCache()
+
+def fingerprint(xml: et.Element) -> bytes:
+    """Return a digest of the content of an XML etree, so that identical content has the same fingerprint wherever it occurs.
+    The tail of the element is excluded, since it is not part of the rendered text.
+    """
+    root = xml.getroot() if isinstance(xml, et._ElementTree) else xml
+    return hashlib.blake2b(et.tostring(root, with_tail=False), digest_size=16).digest()
+
+def to_string(xml: et.Element, params={}, cache: bool = True) -> str:
     """Convert an XML etree to text, removing all tags and rendering editorial tags.
-    Uses global variable `transform`.
+    Uses global variable `renderer` to choose between render() and the XSLT stylesheet in global variable `transform`.
+    Results are memoized in global variable `render_cache`, keyed by the fingerprint of the XML and the parameters, unless `cache` is False.
+    Pass False for XML which is only rendered once, such as a whole entry or folio, so it does not push out the small elements which recur.
     """
-    return xslt_transform(xml, transform, params=params)
+    if cache:
+        key = (fingerprint(xml), tuple(sorted(params.items())), renderer)
+        text = render_cache.get(key)
+        if text is not None:
+            return text
+
+    if renderer == "native":
+        text = render(xml, params=params)
+    elif renderer == "xslt":
+        text = xslt_transform(xml, transform, params=params)
+    else:
+        raise Exception(f"Invalid renderer: '{renderer}'. Renderers: native, xslt")
+
+    profiler.count(f"{renderer} renders")
+    if cache:
+        render_cache.put(key, text)
+    return text
 
 def xslt_transform(xml: et.Element, transform: et.XSLT, params={}) -> str:
     """Apply an XSLT stylesheet to the given XML etree, rendering it as a string.
@@ -30,6 +113,42 @@ def xslt_transform(xml: et.Element, transform: et.XSLT, params={}) -> str:
     """
     return str(transform(xml, **params))
 
+def render(xml: et.Element, params={}) -> str:
+    """Render an XML etree as text by walking the tree directly, producing the same output as annotations.xslt without going through the XSLT engine.
+    Optional argument `params` is a dictionary of XSLT-style parameters, e.g. {"del": "'omit'"}, each setting the mode of one editorial tag.
+    Unlike the stylesheet, an invalid mode raises a ValueError even if the tag does not occur in the XML.
+    """
+    modes = {tag: "annotate" for tag in editorial_tags}
+    for tag, value in params.items():
+        if tag not in modes:
+            continue # the stylesheet ignores unknown parameters too
+        mode = value[1:-1] if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"" else None # parameters are XPath string literals
+        if mode not in editorial_modes[tag]:
+            raise ValueError(f"Bad input for param '{tag}'! Value must be one of: {', '.join(repr(m) for m in editorial_modes[tag])}. Instead got {value!r}.")
+        modes[tag] = mode
+
+    root = xml.getroot() if isinstance(xml, et._ElementTree) else xml
+    parts: List[str] = []
+    render_element(root, modes, parts)
+    return "".join(parts)
+
+def render_element(element: et.Element, modes: Dict[str, str], parts: List[str]) -> None:
+    """Append the rendered text of an element, excluding its tail, to `parts`. Helper function for render()."""
+    mode = modes.get(element.tag) # None unless this is an editorial tag
+    if mode == "omit":
+        return
+    if mode == "annotate":
+        parts.append(editorial_tags[element.tag][0])
+    if element.text:
+        parts.append(element.text)
+    for child in element:
+        if isinstance(child.tag, str): # skip the content of comments and processing instructions, but not their tails
+            render_element(child, modes, parts)
+        if child.tail:
+            parts.append(child.tail)
+    if mode == "annotate":
+        parts.append(editorial_tags[element.tag][1])
+
 def parse_categories(xml: et.Element) -> List[str]:
     """Get the categories attribute of the first div.
     Further divs are merely continuations of the same entry, hence only getting the categories attribute of the first div will suffice.
@@ -45,15 +164,24 @@ def find_terms(xml: et.Element, tag: str, params={}) -> List[str]:
     tags = xml.findall(f".//{tag}")
     return [to_string(tag, params=params).replace("\n", " ") for tag in tags]
 
+def find_all_terms(xml: et.Element, tags, params={}) -> Dict[str, List[str]]:
+    """Like find_terms(), but for several tags at once, collected in a single traversal of the XML etree.
+    Returns a dictionary keyed by tag, each value being the same list find_terms() would return for that tag.
+    """
+    root = xml.getroot() if isinstance(xml, et._ElementTree) else xml
+    terms = OrderedDict((tag, []) for tag in tags)
+    for element in root.iter(*terms.keys()):
+        if element is not root: # like findall(".//tag"), only search descendants
+            terms[element.tag].append(to_string(element, params=params).replace("\n", " "))
+    return terms
+
 def parse_properties(xml: et.Element) -> Dict[str, List[str]]:
     """Return a dictionary keyed by property containing a list of the contents of all tags for that property.
     Returned object has the following schema:
         {prop1: [term1, term2, ...], prop2: [term1, term2, ...], ...}
     """
-    properties = OrderedDict()
-    for prop, tag in utils.prop_dict.items():
-        properties[prop] = find_terms(xml, tag)
-    return properties
+    terms = find_all_terms(xml, utils.prop_dict.values())
+    return OrderedDict((prop, terms[tag]) for prop, tag in utils.prop_dict.items())
 
 def find_title(xml: et.Element) -> str:
     """Get the content of the first "head" tag, rendered in plaintext, but not rendering "del" editorial tags.
@@ -75,25 +203,172 @@ def find_identity(xml: et.Element) -> str:
     else:
         return ''
 
+word_pattern = re.compile(r"\w+") # a token is a run of letters and digits; punctuation, editorial marks and apostrophes separate tokens
+
+@lru_cache(maxsize=None)
+def normalize(word: str) -> str:
+    """Fold a word to the form used for searching: lowercase, without accents, so that e.g. "Païsant" matches "paisant"."""
+    decomposed = unicodedata.normalize("NFKD", word.casefold())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+def tokenize(text: str) -> List[str]:
+    """Split text into a list of normalized words, in order."""
+    return [normalize(match.group()) for match in word_pattern.finditer(text)]
+
+def token_spans(text: str) -> List[Tuple[str, int, int]]:
+    """Like tokenize(), but with the start and end offset of each word in the text."""
+    return [(normalize(match.group()), match.start(), match.end()) for match in word_pattern.finditer(text)]
+
+def in_context(text: str, spans: List[Tuple[int, int]], width: int = 40) -> List[Tuple[str, str, str]]:
+    """Return each span of the text, given by its start and end offset, as a tuple of: the `width` characters before it, the span itself, and the `width` characters after it, with line breaks as spaces."""
+    return [tuple(part.replace("\n", " ") for part in (text[max(0, start - width):start], text[start:end], text[end:end + width])) for start, end in spans]
+
+def parse_term(term: str) -> Tuple[str, List[str]]:
+    """Interpret a search term as a tuple of its kind and its normalized words:
+        ("term", [word]): a single word, e.g. `eau`
+        ("prefix", [prefix]): a single word ending with *, matching any word starting with it, e.g. `fond*`
+        ("phrase", [word1, word2, ...]): several words, matching them in sequence, e.g. `eau de vie` or `l'eau`
+    """
+    words = tokenize(term)
+    if len(words) > 1:
+        return "phrase", words
+    if term.rstrip().endswith("*"):
+        return "prefix", words
+    return "term", words
+
+class derived:
+    """Decorator for an Entry field which is computed from the XML on first access and then cached in a private slot of the same name, prefixed with an underscore."""
+    def __init__(self, func):
+        self.func = func
+        self.slot = "_" + func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        try:
+            return getattr(instance, self.slot)
+        except AttributeError: # not computed yet
+            value = self.func(instance)
+            setattr(instance, self.slot, value)
+            return value
+
+class stored(derived):
+    """Decorator for a derived text field which can be moved to a shared TextStore with Entry.use_store(), after which it is decoded from the store on each access instead of cached."""
+    def __get__(self, instance, owner=None):
+        if instance is not None:
+            location = getattr(instance, "_stored", None)
+            if location and self.slot in location:
+                store, key = location[self.slot]
+                return store[key]
+        return super().__get__(instance, owner)
+
 class Entry:
+    # Fields derived from the XML are only computed when first accessed, so callers only pay for what they use.
+    __slots__ = ("_xml", "_xml_bytes", "identity", "folio", "_text", "_xml_string", "_title", "_categories", "_properties", "_digest", "_tokens", "_token_positions", "_stored")
+    fields = ("xml", "identity", "folio", "text", "xml_string", "title", "categories", "properties")
+
     def __init__(self, xml: et.Element, identity: str=None, folio: str=None):
         """
-        Generate a dictionary full of useful data by parsing the given XML etree.
+        Wrap the given XML etree. Other fields are parsed from it on demand.
         """
+        self.xml = xml
+        self.identity = identity or find_identity(xml) # if you're not given an identity, you can try to discern it from the id attribute of the first div
+        self.folio = folio or "" # if you're not given a folio, don't try to guess!
+
+    @property
+    def xml(self) -> et.Element:
+        """The XML etree. An unpickled entry only reparses it from its serialization when it is first accessed, since its derived fields are usually all that is needed."""
+        try:
+            return self._xml
+        except AttributeError: # unpickled, not parsed yet
+            xml_bytes, is_tree = self._xml_bytes
+            xml = et.fromstring(xml_bytes)
+            self._xml = et.ElementTree(xml) if is_tree else xml # folios are whole documents, entries are single elements
+            del self._xml_bytes
+            return self._xml
+
+    @xml.setter
+    def xml(self, xml: et.Element):
+        self._xml = xml
+
+    @stored
+    def text(self) -> str:
+        return to_string(self.xml, cache=False) # each entry and folio is rendered once, so caching it would only evict reusable renders
 
-        self.data = {}
-        self.data["xml"] = xml
+    @stored
+    def xml_string(self) -> str:
+        return to_xml_string(self.xml)
 
-        self.data["identity"] = identity or find_identity(self.xml) # if you're not given an identity, you can try to discern it from the id attribute of the first div
-        self.data["folio"] = folio or "" # if you're not given a folio, don't try to guess!
+    @derived
+    def title(self) -> str:
+        return find_title(self.xml)
+
+    @derived
+    def categories(self) -> List[str]:
+        return parse_categories(self.xml)
+
+    @derived
+    def properties(self) -> Dict[str, List[str]]:
+        return parse_properties(self.xml)
+
+    @derived
+    def digest(self) -> str:
+        """Hex fingerprint of the entry's content, folio and ID. Used to tell whether its derivatives need to be rebuilt."""
+        return fingerprint(self.xml).hex() + f":{self.folio}:{self.identity}"
+
+    @derived
+    def tokens(self) -> List[Tuple[str, int, int]]:
+        """Normalized words of the text, each with its start and end offset in the text."""
+        return token_spans(self.text)
+
+    @derived
+    def token_positions(self) -> Dict[str, List[int]]:
+        """Positions of each normalized word in tokens."""
+        positions: Dict[str, List[int]] = {}
+        for position, (word, _, _) in enumerate(self.tokens):
+            positions.setdefault(word, []).append(position)
+        return positions
+
+    def find(self, term: str) -> List[Tuple[int, int]]:
+        """Return the start and end offsets in the text of each occurrence of a word, prefix or phrase (see parse_term()), in order.
+        Matching ignores case and accents.
+        """
+        kind, words = parse_term(term)
+        if not words:
+            return []
+        if kind == "prefix":
+            starts = sorted(position for word, positions in self.token_positions.items() if word.startswith(words[0]) for position in positions)
+        else:
+            following = [set(self.token_positions.get(word, ())) for word in words[1:]]
+            starts = [start for start in self.token_positions.get(words[0], []) if all(start + offset in positions for offset, positions in enumerate(following, 1))]
+        return [(self.tokens[start][1], self.tokens[start + len(words) - 1][2]) for start in starts]
 
-        self.data["text"] = to_string(self.xml)
-        self.data["xml_string"] = to_xml_string(self.xml)
+    def context(self, term: str, width: int = 40) -> List[Tuple[str, str, str]]:
+        """Return each occurrence of a word, prefix or phrase in the text (see find()) in context, as a tuple of:
+        the `width` characters before it, the occurrence itself, and the `width` characters after it, with line breaks as spaces.
+        """
+        return in_context(self.text, self.find(term), width=width)
 
-        self.data["title"] = find_title(self.xml)
+    def use_store(self, field: str, store, key: str) -> None:
+        """Read a text field ("text" or "xml_string") from `key` in a TextStore from now on, dropping the entry's own copy."""
+        descriptor = getattr(type(self), field)
+        if not isinstance(descriptor, stored):
+            raise Exception(f"Field cannot be stored: '{field}'. Fields: text, xml_string")
+        location = getattr(self, "_stored", None) or {}
+        location[descriptor.slot] = (store, key)
+        self._stored = location
+        if hasattr(self, descriptor.slot):
+            delattr(self, descriptor.slot)
 
-        self.data["categories"] = parse_categories(self.xml)
-        self.data["properties"] = parse_properties(self.xml)
+    def raw(self, field: str = "text") -> memoryview:
+        """Return the utf-8 bytes of a text field: a slice of its TextStore, without copying, if it was moved to one (see use_store()), otherwise a new encoding of the field."""
+        location = getattr(self, "_stored", None)
+        slot = "_" + field
+        if location and slot in location:
+            store, key = location[slot]
+            return store.view(key)
+        return memoryview(getattr(self, field).encode("utf-8"))
 
     @classmethod
     def from_file(cls, filename: str, identity=None, folio=None):
@@ -106,9 +381,51 @@ class Entry:
         xml = generate_etree(xml_string)
         return cls(xml, identity=identity, folio=folio)
 
+    def precompute(self, fields=None):
+        """Compute derived fields now rather than on first access, e.g. before sending the entry to another process.
+        Optional argument `fields` lists the fields to compute (e.g. ("text", "digest")). Defaults to every field derived from the XML.
+        """
+        for field in fields or self.fields[1:]: # the XML itself is left unparsed if it was unpickled
+            getattr(self, field)
+        return self
+
+    def __getstate__(self):
+        """Support pickling (e.g. to pass entries between processes) by serializing the XML etree, which lxml cannot pickle.
+        Derived fields are included only if they have already been computed.
+        """
+        state = {slot: getattr(self, slot) for slot in self.__slots__ if slot not in ("_xml", "_xml_bytes") and hasattr(self, slot)}
+        if hasattr(self, "_xml"):
+            state["_xml_bytes"] = (et.tostring(self._xml), isinstance(self._xml, et._ElementTree))
+        else: # never parsed since it was unpickled
+            state["_xml_bytes"] = self._xml_bytes
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled entry. Its XML etree is reparsed on first access (see `xml`)."""
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
     def as_dict(self):
-        """Return the data dictionary."""
-        return self.data
+        """Return a dictionary of every field, computing any which have not been computed yet."""
+        return {field: getattr(self, field) for field in self.fields}
+
+    @property
+    def data(self):
+        """The data dictionary, for compatibility with code written before fields were computed lazily, as a read-only view of `as_dict()`.
+        It is rebuilt on each access, so writing to it raises a TypeError rather than silently doing nothing.
+        """
+        return MappingProxyType(self.as_dict())
+
+    def __getattr__(self, attr):
+        """Unknown public attributes are None rather than an error, as they were when fields were kept in the data dictionary.
+        Private names, and fields whose computation raised AttributeError, still raise it.
+        """
+        if attr.startswith("_"):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{attr}'")
+        descriptor = getattr(type(self), attr, None)
+        if descriptor is not None: # a field which failed to compute: compute it again to raise its own error
+            return descriptor.__get__(self, type(self))
+        return None
 
     def __len__(self) -> int:
         """Return the length of the plaintext version of the entry, with full editorial tag renditions.
@@ -116,13 +433,6 @@ class Entry:
         """
         return len(self.text)
 
-    def __getattr__(self, attr):
-        """For convenience, make data dictionary values accessible by treating attributes as keys.
-        E.g. `entry.properties` returns the value of that key in the data dict, effectively `entry.data["properties"]`.
-        """
-        return self.data.get(attr)
-
     def __repr__(self):
         return repr(self.as_dict())
 
-    #TODO: context function to get text around a particular term
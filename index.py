@@ -0,0 +1,157 @@
+"""Inverted indexes over entries: of their rendered text, for full-text search, and of their semantic properties."""
+from typing import List, Dict, Tuple, NamedTuple
+from bisect import bisect_left
+from collections import OrderedDict, Counter
+import math
+import re
+
+from entry import Entry, tokenize, token_spans, parse_term
+
+clause_pattern = re.compile(r'"([^"]*)"|(\S+)') # a quoted phrase, or a single term
+
+def parse_query(query: str) -> List[Tuple[str, List[str]]]:
+    """Split a query into clauses, each of which a matching entry must satisfy. Each clause is a tuple of its kind and its normalized words:
+        ("term", [word]): the word itself, e.g. `eau`
+        ("prefix", [prefix]): any word starting with the prefix, e.g. `fond*`
+        ("phrase", [word1, word2, ...]): the words in sequence, e.g. `"eau de vie"`
+    Terms which contain punctuation, e.g. `l'eau`, are treated as phrases.
+    """
+    clauses = []
+    for match in clause_pattern.finditer(query):
+        phrase, term = match.groups()
+        if phrase is not None:
+            words = tokenize(phrase)
+            kind = "phrase" if len(words) > 1 else "term"
+        else:
+            kind, words = parse_term(term)
+        if words:
+            clauses.append((kind, words))
+    return clauses
+
+class SearchResult(NamedTuple):
+    version: str
+    identity: str
+    folio: str
+    score: float
+
+class InvertedIndex():
+    k1 = 1.2 # BM25 parameters: saturation of repeated matches,
+    b = 0.75 # and how much longer entries are penalized
+
+    def __init__(self, entries: Dict[str, Entry]):
+        """Index the rendered text of the given entries, keyed by ID, with the following schema:
+            {word: {ID: [position of each occurrence of the word in the entry, counted in words]}}
+        along with the start and end offset in the text of the word at each position:
+            {ID: [(start, end), ...]}
+        """
+        self.postings: Dict[str, Dict[str, List[int]]] = {}
+        self.offsets: Dict[str, List[Tuple[int, int]]] = {}
+        self.lengths: Dict[str, int] = OrderedDict() # number of words in each entry, in the order the entries were given
+        for identity, entry in entries.items():
+            spans = token_spans(entry.text)
+            self.lengths[identity] = len(spans)
+            self.offsets[identity] = [(start, end) for _, start, end in spans]
+            for position, (word, _, _) in enumerate(spans):
+                self.postings.setdefault(word, {}).setdefault(identity, []).append(position)
+        self.words = sorted(self.postings) # for prefix lookups
+        self.order = {identity: i for i, identity in enumerate(self.lengths)} # to break ties between equally relevant entries
+        self.average_length = sum(self.lengths.values()) / len(self.lengths) if self.lengths else 0
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def matches(self, kind: str, words: List[str]) -> Dict[str, List[int]]:
+        """Return the position of the first word of each match of a clause (see parse_query()), in order, in each entry that contains it, keyed by ID."""
+        if kind == "term":
+            return self.postings.get(words[0], {})
+
+        if kind == "prefix":
+            starts: Dict[str, List[int]] = {}
+            for i in range(bisect_left(self.words, words[0]), len(self.words)):
+                if not self.words[i].startswith(words[0]):
+                    break
+                for identity, positions in self.postings[self.words[i]].items():
+                    starts.setdefault(identity, []).extend(positions)
+            return {identity: sorted(positions) for identity, positions in starts.items()}
+
+        if kind == "phrase":
+            postings = [self.postings.get(word, {}) for word in words]
+            starts = {}
+            for identity in min(postings, key=len): # only entries containing the rarest word can match
+                if not all(identity in posting for posting in postings):
+                    continue
+                positions = [set(posting[identity]) for posting in postings]
+                matched = [start for start in postings[0][identity] if all(start + offset in positions[offset] for offset in range(1, len(words)))]
+                if matched:
+                    starts[identity] = matched
+            return starts
+
+        raise ValueError(f"Invalid clause: '{kind}'. Clauses: term, prefix, phrase")
+
+    def lookup(self, kind: str, words: List[str]) -> Dict[str, int]:
+        """Return the number of matches of a clause (see parse_query()) in each entry that contains it, keyed by ID."""
+        return {identity: len(starts) for identity, starts in self.matches(kind, words).items()}
+
+    def spans(self, identity: str, starts: List[int], length: int) -> List[Tuple[int, int]]:
+        """Return the start and end offset in an entry's text of each match of `length` words beginning at the given positions, e.g. those of matches()."""
+        offsets = self.offsets[identity]
+        return [(offsets[start][0], offsets[start + length - 1][1]) for start in starts]
+
+    def search(self, query: str, identities=None) -> List[Tuple[str, float]]:
+        """Return the IDs of the entries matching every clause of the query (see parse_query()), with their BM25 relevance scores, best first.
+        Optional argument `identities` restricts the results to entries with those IDs.
+        """
+        clauses = parse_query(query)
+        if not clauses or not self.lengths:
+            return []
+
+        matches = [self.lookup(kind, words) for kind, words in clauses]
+        candidates = set(min(matches, key=len))
+        for counts in matches:
+            candidates.intersection_update(counts)
+        if identities is not None:
+            candidates.intersection_update(identities)
+
+        scores = {}
+        for identity in candidates:
+            length_ratio = self.lengths[identity] / self.average_length if self.average_length else 0
+            score = 0.0
+            for counts in matches:
+                frequency = counts[identity]
+                idf = math.log(1 + (len(self.lengths) - len(counts) + 0.5) / (len(counts) + 0.5))
+                score += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length_ratio))
+            scores[identity] = score
+
+        return sorted(scores.items(), key=lambda item: (-item[1], self.order[item[0]]))
+
+class PropertyIndex():
+    def __init__(self, entries: Dict[str, Dict[str, Entry]]):
+        """Index the property terms of the given entries, keyed by version and then by ID, as Manuscript.entries is.
+        Each term is kept verbatim, as it appears in Entry.properties. The index has the following schema:
+            {prop: {version: {term: {ID: number of occurrences of the term in the entry}}}}
+        along with the reverse mapping:
+            {(version, ID): {prop: {term: number of occurrences}}}
+        Both are filled in a single pass over the properties of each entry.
+        """
+        self.postings: Dict[str, Dict[str, Dict[str, Dict[str, int]]]] = {}
+        self.entry_postings: Dict[Tuple[str, str], Dict[str, Counter]] = {}
+        for version, es in entries.items():
+            for identity, entry in es.items():
+                entry_terms = self.entry_postings[(version, identity)] = OrderedDict()
+                for prop, terms in entry.properties.items():
+                    counts = entry_terms[prop] = Counter(terms)
+                    version_postings = self.postings.setdefault(prop, {}).setdefault(version, {})
+                    for term, count in counts.items():
+                        version_postings.setdefault(term, OrderedDict())[identity] = count
+
+    def lookup(self, prop: str, version: str, term: str) -> Dict[str, int]:
+        """Return the number of occurrences of a verbatim term of a property in each entry of a version which contains it, keyed by ID, in entry order."""
+        return self.postings.get(prop, {}).get(version, {}).get(term, {})
+
+    def terms(self, prop: str, version: str) -> Dict[str, Dict[str, int]]:
+        """Return every term of a property in a version, each with the entries which contain it, as lookup() would."""
+        return self.postings.get(prop, {}).get(version, {})
+
+    def entry_terms(self, version: str, identity: str) -> Dict[str, Counter]:
+        """Return the terms of each property in an entry, with their number of occurrences, or an empty dictionary if there is no such entry."""
+        return self.entry_postings.get((version, identity), {})
@@ -0,0 +1,73 @@
+"""Timers and counters recording where the time of an update goes, reported by update.py --profile."""
+from typing import Dict
+import json
+import time
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict, Counter
+
+logger = logging.getLogger(__name__)
+
+class Profiler():
+    def __init__(self):
+        """Accumulate the time spent in each stage of the pipeline, with the number of times it ran, and counts of events such as files parsed.
+        Stages nest: a stage entered while another is running is named after both, e.g. "update_entries/tl".
+        Stages are timed from the main thread; counters may be incremented from any thread.
+        """
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.started = time.perf_counter()
+        self.stages: Dict[str, list] = OrderedDict() # [seconds, calls] keyed by stage name, in the order stages were first entered
+        self.counters: Counter = Counter()
+        self.stack = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """Context manager timing the code it wraps as a stage."""
+        self.stack.append(name)
+        path = "/".join(self.stack)
+        record = self.stages.setdefault(path, [0.0, 0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            record[0] += elapsed
+            record[1] += 1
+            logger.debug("%s took %.3fs.", path, elapsed)
+
+    def timed(self, name: str):
+        """Decorator timing every call of a function as a stage."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += n
+
+    def report(self) -> Dict:
+        """Return the timings and counts recorded since the profiler was created or reset, as a dictionary which can be saved as JSON."""
+        return {
+            "total_seconds": round(time.perf_counter() - self.started, 6),
+            "stages": [{"name": name, "seconds": round(seconds, 6), "calls": calls} for name, (seconds, calls) in self.stages.items()],
+            "counters": dict(self.counters),
+        }
+
+    def write(self, path: str, **extra) -> None:
+        """Write the report to a JSON file, along with any `extra` keys."""
+        report = self.report()
+        report.update(extra)
+        with open(path, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=1)
+
+profiler = Profiler() # shared by every module, so a single report covers the whole update
@@ -1,132 +1,92 @@
 """ Data transform to generate a folder of .json files containing properties and the entries that contain them. """
 # Python Modules
 import os
-import re
-from typing import Dict, Tuple, List
-
-# Third Party Modules
-import pandas as pd
-from tqdm import tqdm
+import csv
+import json
+from collections import OrderedDict
+from typing import Dict, List, Tuple, TextIO
 
 # Local Modules
-from digital_manuscript import BnF
-from recipe import Recipe
+from manuscript import Manuscript, display_id
 
 properties = ['animal', 'body_part', 'currency', 'definition', 'environment', 'material',
               'medical', 'measurement', 'music', 'plant', 'place', 'personal_name',
               'profession', 'sensory', 'tool', 'time', 'weapon']
 
-def read_csvs() -> Dict[str, pd.DataFrame]:
-  """
-  Read thesaurus file and save keyed by property.
-  Input: None
-  Output: df_dict -- a dict where they keys are an element of properties and the value is the thesaurus
-  DataFrame for that property.
-  """
-  df_dict = {}
-  for prop in properties:
-    df = pd.read_csv(f'thesaurus/{prop}.csv')
-    # add new column containing empty lists to store entries
-    df['entries'] = df.apply(lambda x: [], axis=1)
-    df_dict[prop] = df
-  return df_dict
-
-def read_manuscript(manuscript: BnF, df_dict: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+def read_thesaurus(prop: str) -> List[Dict[str, str]]:
   """
-  Iterate through the manuscript and each row in each of the DataFrames. Add entry identities to rows
-  for properties that entry has.
-
-  Input: manuscript -- The complete BnF Ms 640 digital manuscript.
-  Output: df_dict -- a dict where they keys are an element of properties and the value is the thesaurus
-  DataFrame for that property.
+  Read the thesaurus file of a property.
+  Input: prop -- an element of properties
+  Output: a list of rows, each a dict with the keys 'freq', 'verbatim_term' and 'prefLabel_en', in file order.
   """
-  for identity in tqdm(manuscript.entries.keys()):
-    entry = manuscript.entries[identity]
-    for prop in properties:
-      df = df_dict[prop]
-      prop_list = entry.get_prop(prop, 'tl')
-      for j, row, in df.iterrows():
-        if any(term == row.verbatim_term for term in prop_list):
-          entry_list = row.entries.copy()
-          entry_list.append(entry)
-          df.loc[j] = [row.freq, row.verbatim_term, row.prefLabel_en, entry_list.copy()]
-          df_dict[prop] = df
-  return df_dict
+  with open(f'thesaurus/{prop}.csv', 'r', encoding='utf-8', newline='') as f:
+    return list(csv.DictReader(f))
 
-def df_to_dict(df = pd.DataFrame) -> Dict[str, Tuple[Recipe, str]]:
+def match_terms(manuscript: Manuscript, prop: str, rows: List[Dict[str, str]]) -> Dict[str, List[Tuple[str, str]]]:
   """
-  Convert dataframe into dict of the following format:
-  'prefLabel_en1': [(entry1, verbatim_term1), (entry2, verbatim_term2), ...],
-  'prefLabel_en2: [(entry3, verbatim_term3), ...], ...
-
-  Inputs: df -- dataframe contianing columns 'prefLabel_en', 'verbatim_term', and 'entries'
-  Outputs: prop_dict 
+  Join the rows of a property's thesaurus to the entries of the TL version containing their verbatim term, using the
+  manuscript's property index, which maps each verbatim term to its entries.
+
+  Inputs: manuscript -- The complete BnF Ms 640 digital manuscript.
+          prop -- an element of properties
+          rows -- the thesaurus rows of that property, as returned by read_thesaurus()
+  Output: a dict of the following format, in thesaurus order, then folio order of the entries of each verbatim term:
+  'prefLabel_en1': [(identity1, verbatim_term1), (identity2, verbatim_term2), ...],
+  'prefLabel_en2': [(identity3, verbatim_term3), ...], ...
   """
-  prop_dict = {}
-  for _, row in df.iterrows():
-    for entry in row.entries:
-      info_list = prop_dict.get(row.prefLabel_en, [])
-      info_list.append((entry, row.verbatim_term))
-      prop_dict[row.prefLabel_en] = info_list.copy()
+  prop_dict = OrderedDict()
+  for row in rows:
+    identities = manuscript.property_index.lookup(prop, 'tl', row['verbatim_term'])
+    if identities:
+      # Entries are keyed by their Manuscript ID, e.g. 10r1, which does not sort by folio, unlike the display ID, p010r_1.
+      prop_dict.setdefault(row['prefLabel_en'], []).extend((identity, row['verbatim_term']) for identity in sorted(identities, key=display_id))
   return prop_dict
 
-def write_json(prop_dict, prop: str) -> None:
-  text = '{\n'
-  for term, info_list in prop_dict.items():
-    text += f'  "{term}": [\n'
-    for info_tuple in info_list:
-      entry, verbatim_term = info_tuple
-      iden, title = entry.identity, entry.title['tl'].strip()
-
-      text += '    {\n'
-      text += f'    "verbatim_term": "{verbatim_term}",\n'
-      text += f'    "entry_id": "{iden}",\n'
-      text += f'    "entry_title": "{title}"\n'
-      text += '    },\n'
-    text += "  ],\n"
-  text += '}'
-
-  text = re.sub(r',\n  ]', '\n  ]', text) # remove inner trailing commas
-  text = re.sub(r'],\n}', ']\n}', text) # remove outer trailing commas
-
-  f = open(f"jsons/{prop}.json", "w") # save to a file in /jsons/
-  f.write(text)
-  f.close() 
-
-def write_csv(prop_dict, prop: str) -> None: 
-  f = open(f'properties/{prop}.csv', "w")
-  f.write('prefLabel_en,verbatim_term,identity,title\n')
-
-  for term, info_list in prop_dict.items():
-    for info_tuple in info_list:
-      entry, verbatim_term = info_tuple
-      iden, title = entry.identity, entry.title['tl']
-      f.write(f'{term},{verbatim_term},{iden},{title}\n')
-  f.close()
-
-def write_files(df_dict) -> None:
+def write_json(manuscript: Manuscript, prop_dict: Dict[str, List[Tuple[str, str]]], prop: str) -> None:
   """
-  Write each dataframe to a JSON of the following format. Create a new DataFrame with one entry per row and save
-  it as a .csv.
+  Write matches to jsons/{prop}.json, one entry at a time, in the following format:
   {
-    term1: {
-      "entry1": "title1",
-      "entry2": "title2",
+    "prefLabel_en1": [
+      {
+      "verbatim_term": "verbatim_term1",
+      "entry_id": "p001r_1",
+      "entry_title": "title1"
+      },
       ...
-    },
+    ],
     ...
   }
-
-  Input: df_dict -- a dict where they keys are an element of properties and the value is the thesaurus
-  DataFrame for that property.
-  Output: None
   """
-  for prop, df in df_dict.items():
-    prop_dict = df_to_dict(df)
-    write_json(prop_dict, prop)
-    write_csv(prop_dict, prop)
-
-def jsonify():
+  with open(f'jsons/{prop}.json', 'w', encoding='utf-8') as f:
+    f.write('{')
+    for i, (term, info_list) in enumerate(prop_dict.items()):
+      f.write(f'{"," if i else ""}\n  {json.dumps(term, ensure_ascii=False)}: [')
+      for j, (identity, verbatim_term) in enumerate(info_list):
+        f.write(',' if j else '')
+        write_record(f, OrderedDict([
+          ('verbatim_term', verbatim_term),
+          ('entry_id', display_id(identity)),
+          ('entry_title', manuscript.entries['tl'][identity].title.strip()),
+        ]))
+      f.write('\n  ]')
+    f.write('\n}')
+
+def write_record(f: TextIO, record: Dict[str, str]) -> None:
+  """ Write a JSON object as an element of a list nested in the top-level object, with its keys indented as much as its braces, as in the committed jsons. """
+  f.write('\n    {')
+  f.write(','.join(f'\n    {json.dumps(key, ensure_ascii=False)}: {json.dumps(value, ensure_ascii=False)}' for key, value in record.items()))
+  f.write('\n    }')
+
+def write_csv(manuscript: Manuscript, prop_dict: Dict[str, List[Tuple[str, str]]], prop: str) -> None:
+  """ Write matches to properties/{prop}.csv, with one row per term per entry. """
+  with open(f'properties/{prop}.csv', 'w', encoding='utf-8', newline='') as f:
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(['prefLabel_en', 'verbatim_term', 'identity', 'title'])
+    for term, info_list in prop_dict.items():
+      for identity, verbatim_term in info_list:
+        writer.writerow([term, verbatim_term, display_id(identity), manuscript.entries['tl'][identity].title])
+
+def jsonify(manuscript: Manuscript = None) -> None:
   """ Controller for the file. Match entries to properties and write files. """
 
   # Check for prerequesite files
@@ -139,9 +99,11 @@ def jsonify():
     if not os.path.exists(folder):
       os.mkdir(folder)
 
-  manuscript = BnF(apply_corrections=False)
-  df_dict = read_csvs() # read in thesaurus
-  df_dict = read_manuscript(manuscript, df_dict) # match entries to terms
-  write_files(df_dict) # write jsons and csvs
+  manuscript = manuscript or Manuscript.load_cached()
+  for prop in properties:
+    prop_dict = match_terms(manuscript, prop, read_thesaurus(prop)) # match entries to terms
+    write_json(manuscript, prop_dict, prop)
+    write_csv(manuscript, prop_dict, prop)
 
-jsonify()
+if __name__ == '__main__':
+  jsonify()
@@ -0,0 +1,88 @@
+"""Manifests recording what each derivative folder was last built from, for incremental builds."""
+from typing import List, Tuple, Dict, Iterable
+import os
+import json
+import hashlib
+
+import utils
+from writer import atomic_open
+
+format_version = 2 # Increment when the manifest schema or the layout of derivatives changes, to force a full rebuild.
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+def hash_file(filepath: str) -> str:
+    with open(filepath, 'rb') as fp:
+        return hash_bytes(fp.read())
+
+# Code which determines the content of derivatives: rendering, metadata columns, allFolios serialization and file names, properties, and the objects of a cached Manuscript.
+code_modules = ("entry.py", "manuscript.py", "index.py", "textstore.py", "utils.py")
+
+def build_key() -> str:
+    """Return a hash of everything besides the sources that determines the content of derivatives: the stylesheet and the code in `code_modules`.
+    If it changes, manifests written before the change are ignored and every derivative is rebuilt.
+    """
+    code_dir = os.path.abspath(os.path.dirname(__file__))
+    data = str(format_version).encode()
+    for path in (utils.stylesheet_path, *(os.path.join(code_dir, module) for module in code_modules)):
+        with open(path, 'rb') as fp:
+            data += fp.read()
+    return hash_bytes(data)
+
+class Manifest():
+    filename = ".manifest.json"
+
+    def __init__(self, outdir: str):
+        """Load the manifest kept in a derivative folder, if there is one. Its schema is:
+            {
+                "format": format_version,
+                "build": build_key(),
+                "sources": {version: {folio: hash of source file}},
+                "fingerprints": {unit: fingerprint},
+                "outputs": [path of each output file, relative to the folder],
+            }
+        where a unit is whatever each output file is generated from (a folio, an entry, a version...) and its fingerprint is a hash of that content.
+        The manifest is only `valid` if it was written by the same build as the current one.
+        """
+        self.outdir = outdir
+        self.path = os.path.join(outdir, self.filename)
+        self.build = build_key()
+        self.sources: Dict[str, Dict[str, str]] = {}
+        self.fingerprints: Dict[str, str] = {}
+        self.outputs: List[str] = []
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError): # missing or corrupt manifest
+            data = {}
+
+        self.valid = data.get("format") == format_version and data.get("build") == self.build
+        if self.valid:
+            self.sources = data.get("sources", {})
+            self.fingerprints = data.get("fingerprints", {})
+            self.outputs = data.get("outputs", [])
+
+    def up_to_date(self, sources: Dict[str, Dict[str, str]]) -> bool:
+        """Return whether the folder was built from exactly these source file hashes and still has all its output files, in which case nothing needs to be rebuilt."""
+        return self.valid and self.sources == sources and all(os.path.exists(os.path.join(self.outdir, path)) for path in self.outputs)
+
+    def diff(self, fingerprints: Dict[str, str]) -> Tuple[List[str], List[str]]:
+        """Compare the current fingerprint of each unit with the manifest.
+        Returns a tuple of two lists: the units which are new or changed, in the order given, and the units which no longer exist.
+        """
+        stale = [unit for unit, fingerprint in fingerprints.items() if self.fingerprints.get(unit) != fingerprint]
+        removed = [unit for unit in self.fingerprints if unit not in fingerprints]
+        return stale, removed
+
+    def save(self, fingerprints: Dict[str, str], sources: Dict[str, Dict[str, str]], outputs: Iterable[str] = ()) -> None:
+        """Record the current fingerprints and source file hashes, and the paths of the output files, replacing the manifest file atomically."""
+        self.sources = sources
+        self.fingerprints = dict(fingerprints)
+        self.outputs = sorted(os.path.relpath(path, self.outdir) for path in outputs)
+        self.valid = True
+        data = {"format": format_version, "build": self.build, "sources": self.sources, "fingerprints": self.fingerprints, "outputs": self.outputs}
+
+        with atomic_open(self.path, 'w', encoding='utf-8') as fp: # a temporary file of its own, so overlapping updates do not write into each other's
+            json.dump(data, fp, indent=1, sort_keys=True)
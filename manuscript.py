@@ -1,18 +1,27 @@
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, BinaryIO, Iterator
 from lxml import etree as et
 from pandas import DataFrame
+import numpy as np
 import os
 import sys
-import shutil # For recursively removing directories.
+import csv
+import pickle
+import logging
+from io import StringIO, BytesIO
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
-from collections import OrderedDict
+from collections import OrderedDict, Counter
 
 import utils
 import entry
+from utils import ignore_data_path
+from manifest import Manifest, hash_file, hash_bytes, build_key
+from writer import OutputWriter, atomic_open
+from index import InvertedIndex, PropertyIndex, SearchResult
+from instrument import profiler
+from textstore import TextStore
 
-def ignore_data_path(filepath: str) -> str:
-    """Remove the manuscript data path portion from a filepath."""
-    return filepath.partition(os.path.commonpath([os.path.abspath(filepath), utils.manuscript_data_path]))[2]
+logger = logging.getLogger(__name__)
 
 def extract_folio(filepath: str) -> str:
     """Get the folio out of a filepath which points to a folio XML file.
@@ -36,20 +45,100 @@ def display_id(identity: str) -> str:
     # inverse of clean_id()
     return "p" + identity[:-1].zfill(4) + "_" + identity[-1]
 
-def separate_by_id(filepath: str) -> Dict[str, et.Element]:
-    """Take a file path, read it as XML, and process it into separate elements by ID.
+cache_format = 1 # Increment when the layout of cached Manuscript objects changes, to invalidate caches written before.
+
+parse_counts: Counter = Counter() # Number of times each source file has been parsed, keyed by file path.
+
+def parse_file(filepath: str) -> et.ElementTree:
+    """Read a file as an XML etree, recording the parse in `parse_counts`."""
+    parse_counts[filepath] += 1
+    profiler.count("files parsed")
+    return et.parse(filepath)
+
+def is_source_file(filename: str) -> bool:
+    """Return whether a filename is that of a folio's XML file, e.g. tl_p162v_preTEI.xml.
+    Hidden files and editor backups, e.g. .tl_p162v_preTEI.xml.swp or tl_p162v_preTEI.xml~, would otherwise be read as another copy of the folio.
+    """
+    return filename.endswith("_preTEI.xml") and not filename.startswith(".")
+
+def list_files(directory: str) -> List[str]:
+    """Return the paths of all folio XML files in the given directory (see is_source_file()), recursively, in folio order.
+    Folio filenames are zero-padded (e.g. tl_p0162v_preTEI.xml), so sorting by name sorts by folio.
+    """
+    paths = []
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            if is_source_file(filename):
+                paths.append(os.path.join(root, filename))
+    return sorted(paths, key=os.path.basename)
+
+def load_dir(directory: str) -> List[Tuple[str, et.ElementTree]]:
+    """Shared load stage: parse each XML file in the given directory exactly once.
+    Returns a list of (folio, etree) tuples in folio order, from which both entries and folios can be generated.
+    """
+    logger.info("Loading files from folder %s...", directory)
+    sources = [(extract_folio(filepath), parse_file(filepath)) for filepath in list_files(directory)]
+    logger.info("Parsed %d file%s in folder %s.", len(sources), '' if len(sources)==1 else 's', directory)
+    return sources
+
+def hash_dir(directory: str) -> Dict[str, str]:
+    """Return a hash of each source file in the given directory, keyed by folio."""
+    return OrderedDict((extract_folio(filepath), hash_file(filepath)) for filepath in list_files(directory))
+
+def cache_key(directories) -> Dict:
+    """Return what a cached manuscript must have been built from to be reused: the cache format, the code and stylesheet (see manifest.build_key()), and a hash of each source file by version."""
+    return {"format": cache_format, "build": build_key(), "sources": [(os.path.basename(directory), hash_dir(directory)) for directory in directories]}
+
+def store_hashes(ms) -> Dict[str, str]:
+    """Return a hash of each text store file a manuscript refers to (see Manuscript.compact()), keyed by path."""
+    return {store.path: hash_file(store.path) for store in ms.text_stores.values() if store.path}
+
+def read_cache(path: str, key: Dict):
+    """Load a cached manuscript, or return None if there is none, it was built from anything else than `key`,
+    or a text store file it refers to is missing or was replaced since.
+    The key is stored first, so an outdated cache is rejected without loading the manuscript.
+    """
+    try:
+        with open(path, 'rb') as fp:
+            stored = pickle.load(fp)
+            stores = stored.pop("stores", {})
+            if stored != key or not all(os.path.exists(store_path) and hash_file(store_path) == store_hash for store_path, store_hash in stores.items()):
+                return None
+            return pickle.load(fp)
+    except Exception: # missing, corrupt or incompatible cache
+        return None
+
+def write_cache(path: str, key: Dict, ms) -> None:
+    """Write a manuscript and its key to a cache file, replacing it atomically. The key also records the hash of each text store file the manuscript refers to."""
+    with atomic_open(path, 'wb') as fp: # a temporary file of its own, so sessions loading the same cache at once do not write into each other's
+        pickle.dump(dict(key, stores=store_hashes(ms)), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(ms, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+def separate_by_id(source) -> Dict[str, et.Element]:
+    """Take a file path or an already parsed XML etree and process it into separate elements by ID.
     Returned object is a dictionary of lxml.etree.Element objects keyed by entry ID as a string.
     Divs without IDs will lumped together into one object keyed by an empty string.
+    If given a parsed etree, its divs are copied rather than moved, so the etree itself is left intact.
     """
     entries = OrderedDict()
 
-    print(f"Separating divs in file: {ignore_data_path(filepath)}...")
-    xml = et.parse(filepath)
+    if isinstance(source, str):
+        xml = parse_file(source)
+        copy = False
+    else:
+        xml = source
+        copy = True
+    debug = logger.isEnabledFor(logging.DEBUG) # only build messages if they will be shown
+    if debug:
+        name = ignore_data_path(source if isinstance(source, str) else (source.docinfo.URL or ""))
+        logger.debug("Separating divs in file: %s...", name)
 
     divs = xml.findall("div") # not recursive, which is okay since there should be no nested divs
 
     for div in divs:
         key = div.get("id") or ""
+        if copy:
+            div = deepcopy(div)
 
         if key in entries.keys():
             entries[key].append(div) # add continued entry in-place
@@ -58,59 +147,193 @@ def separate_by_id(filepath: str) -> Dict[str, et.Element]:
             root.append(div) # put the current div in the new tree
             entries[key] = root
 
-    print(f"Found {len(entries)} div{'' if len(entries)==1 else 's'} in file {ignore_data_path(filepath)} with ID{'' if len(entries)==1 else 's'}: {', '.join(entries.keys())}.")
+    if debug:
+        logger.debug("Found %d div%s in file %s with ID%s: %s.", len(entries), '' if len(entries)==1 else 's', name, '' if len(entries)==1 else 's', ', '.join(entries.keys()))
 
     return entries
 
-def generate_entries(directory) -> List[entry.Entry]:
+def generate_entries(directory, sources: List[Tuple[str, et.ElementTree]] = None) -> List[entry.Entry]:
     """Given the path to a directory of XML files, generate a list of Entry objects.
     Entry objects are generated by processing the files into their constituent divs and connecting divs with the same ID together, even across files.
     Divs without IDs are ignored and not included in the returned list.
     The folio of each entry is considered to be the folio of the first div in the entry.
+    Optional argument `sources` is the output of `load_dir(directory)`, to avoid parsing the files again.
     """
-    print(f"Generating entries from files in folder {directory}...")
+    logger.info("Generating entries from files in folder %s...", directory)
+
+    if sources is None:
+        sources = load_dir(directory)
 
     # First, get the XML etree of each entry, keyed by ID.
     xml_dict: Dict[str, et.Element] = OrderedDict()
     folios_by_id = {} # Keep track of which folio is associated with each ID.
 
-    for root, _, files in os.walk(directory):
-        for filename in files:
-            folio = extract_folio(filename)
-            entries: Dict[str, et.Element] = separate_by_id(os.path.join(root, filename)) # Process the individual file into a dictionary.
-
-            # Merge individual file's XML etrees with the greater dict of XML etrees.
-            # If that ID is already a key in the dict, append all the divs from this file with that ID to the existing XML etree.
-            # Otherwise, create a new key-value pair for that ID.
-            for identity, xml in entries.items():
-                if identity in xml_dict.keys():
-                    for div in xml.findall("div"): # Extract divs from xml.
-                        xml_dict[identity].append(div) # Append each div.
-                elif identity: # Only add it to the dict if it has an ID.
-                    xml_dict[identity] = xml
-                    folios_by_id[identity] = folio
+    for folio, tree in sources:
+        entries: Dict[str, et.Element] = separate_by_id(tree) # Process the individual file into a dictionary.
+
+        # Merge individual file's XML etrees with the greater dict of XML etrees.
+        # If that ID is already a key in the dict, append all the divs from this file with that ID to the existing XML etree.
+        # Otherwise, create a new key-value pair for that ID.
+        for identity, xml in entries.items():
+            if identity in xml_dict.keys():
+                for div in xml.findall("div"): # Extract divs from xml.
+                    xml_dict[identity].append(div) # Append each div.
+            elif identity: # Only add it to the dict if it has an ID.
+                xml_dict[identity] = xml
+                folios_by_id[identity] = folio
 
     # With the entire directory parsed into XML etrees by div, convert each XML etree into an Entry object.
     entries: List[entry.Entry] = []
 
     for identity, xml in xml_dict.items():
         folio = folios_by_id[identity]
-        print(f"Generating entry with folio {folio}, ID {identity}...")
+        logger.debug("Generating entry with folio %s, ID %s...", folio, identity)
         entries.append(entry.Entry(xml, folio=clean_folio(folio), identity=clean_id(identity)))
 
-    print(f"Generated {len(entries)} entr{'y' if len(entries)==1 else 'ies'}.")
+    logger.info("Generated %d entr%s.", len(entries), 'y' if len(entries)==1 else 'ies')
     return list(sorted(entries, key=lambda e: e.identity))
 
-def generate_folios(directory) -> List[entry.Entry]:
+def generate_folios(directory, sources: List[Tuple[str, et.ElementTree]] = None) -> List[entry.Entry]:
     """Given the path to a directory of XML files, generate a list of Entry objects by loading each file as its own entry.
+    Optional argument `sources` is the output of `load_dir(directory)`, to avoid parsing the files again.
     """
+    if sources is None:
+        sources = load_dir(directory)
+
     folios = []
-    for root, _, files in os.walk(directory):
-        for filename in files:
-            print(f"Generating folio from file {ignore_data_path(os.path.join(root, filename))}...")
-            folios.append(entry.Entry.from_file(os.path.join(root, filename), folio=clean_folio(extract_folio(filename))))
+    for folio, tree in sources:
+        logger.debug("Generating folio %s from folder %s...", folio, directory)
+        folios.append(entry.Entry(tree, folio=clean_folio(folio)))
     return list(sorted(folios, key=lambda e: e.folio))
 
+def iter_divs(filepath: str) -> Iterator[et.Element]:
+    """Parse a file incrementally, yielding each top-level div as soon as its end tag is read.
+    Divs which the caller did not move elsewhere, e.g. into an entry, are removed from the file's tree once the caller moves on, so at most one div of the file is held at a time.
+    """
+    parse_counts[filepath] += 1
+    profiler.count("files parsed")
+    for _, div in et.iterparse(filepath, events=("end",), tag="div"):
+        parent = div.getparent()
+        if parent is None or parent.getparent() is not None: # nested div, which belongs to the top-level div around it
+            continue
+        yield div
+        if div.getparent() is parent:
+            parent.remove(div)
+
+def iter_entries(directory, window: int = 1) -> Iterator[entry.Entry]:
+    """Given the path to a directory of XML files, yield an Entry object for each entry, without loading the whole directory.
+    Files are parsed incrementally in folio order, and each entry is yielded as soon as it is closed, i.e. once `window` folios have been read
+    since the last folio with a div of its ID. Continued entries are expected on the next folio, so by default only the entries of the last folio read are held in memory.
+    Entries are the same as those of generate_entries(), but in the order they were closed rather than sorted by ID. Divs without IDs are ignored.
+    If a div turns up after its entry was closed, it is yielded as a separate entry with the same ID, and a warning is logged: use a larger `window` if continued entries may skip folios.
+    """
+    logger.info("Generating entries from files in folder %s...", directory)
+    open_entries: Dict[str, list] = OrderedDict() # [folio of the first div, XML etree, index of the last folio with a div] keyed by ID, in the order entries were opened
+    closed = set()
+    n = 0
+
+    def close(identity: str) -> entry.Entry:
+        folio, xml, _ = open_entries.pop(identity)
+        closed.add(identity)
+        logger.debug("Generating entry with folio %s, ID %s...", folio, identity)
+        return entry.Entry(xml, folio=clean_folio(folio), identity=clean_id(identity))
+
+    for index, filepath in enumerate(list_files(directory)):
+        folio = extract_folio(filepath)
+        for div in iter_divs(filepath):
+            identity = div.get("id")
+            if not identity:
+                continue
+            if identity in open_entries:
+                open_entries[identity][1].append(div) # add continued entry in-place
+                open_entries[identity][2] = index
+            else:
+                if identity in closed:
+                    logger.warning("Div with ID %s in folio %s was found after its entry was closed.", identity, folio)
+                root = et.Element("entry") # start a new entry with an <entry></entry> element
+                root.append(div)
+                open_entries[identity] = [folio, root, index]
+
+        for identity in [identity for identity, (_, _, last) in open_entries.items() if index - last >= window]:
+            n += 1
+            yield close(identity)
+
+    for identity in list(open_entries):
+        n += 1
+        yield close(identity)
+    logger.info("Generated %d entr%s.", n, 'y' if n==1 else 'ies')
+
+# Fields computed by worker processes (see generate_parallel()): those read by the derivatives. Any other field is computed on first access, from the XML.
+entry_fields = ("text", "xml_string", "title", "categories", "properties", "digest")
+folio_fields = ("text", "digest")
+
+def _init_worker(renderer: str):
+    """Set up a worker process: use the parent's renderer and silence progress messages, since the parent process reports progress as results arrive."""
+    entry.renderer = renderer
+    logging.disable(logging.INFO)
+
+def _load_file(filepath: str) -> Tuple[str, entry.Entry, Dict[str, List[bytes]]]:
+    """Worker for `generate_parallel`: parse one file, generate its folio, and separate its divs by ID.
+    Divs are returned serialized, since lxml elements cannot be sent between processes.
+    """
+    tree = parse_file(filepath)
+    folio = extract_folio(filepath)
+    divs = OrderedDict((identity, [et.tostring(div) for div in xml]) for identity, xml in separate_by_id(tree).items())
+    return folio, entry.Entry(tree, folio=clean_folio(folio)).precompute(folio_fields), divs
+
+def _build_entry(args: Tuple[bytes, str, str]) -> entry.Entry:
+    """Worker for `generate_parallel`: generate an Entry from its serialized XML."""
+    xml_bytes, folio, identity = args
+    return entry.Entry.from_string(xml_bytes, folio=clean_folio(folio), identity=clean_id(identity)).precompute(entry_fields)
+
+def generate_parallel(directories, workers: int = None) -> Tuple[Dict[str, List[entry.Entry]], Dict[str, List[entry.Entry]]]:
+    """Generate the entries and folios of several manuscript versions using a pool of worker processes.
+    Files of every version are parsed in parallel, continued divs are joined in the parent process in folio order just as `generate_entries` joins them,
+    and the resulting entries are then generated in parallel. Results are merged in input order, so the output does not depend on scheduling.
+    Workers only compute the fields the derivatives read (see `entry_fields` and `folio_fields`), and the XML of each entry and folio is only reparsed in this process if it is accessed.
+    Returns a tuple of two dictionaries, (entries, folios), each keyed by version with lists of Entry objects as values.
+    """
+    workers = workers or os.cpu_count() or 1
+    files = [(os.path.basename(directory), filepath) for directory in directories for filepath in list_files(directory)]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(entry.renderer,)) as executor:
+        chunksize = max(1, len(files) // (4 * workers))
+        loaded = executor.map(_load_file, [filepath for _, filepath in files], chunksize=chunksize)
+
+        # Join continued divs by ID within each version, in folio order.
+        divs_by_id: Dict[str, Dict[str, List[bytes]]] = OrderedDict((os.path.basename(directory), OrderedDict()) for directory in directories)
+        folios_by_id: Dict[str, Dict[str, str]] = {version: {} for version in divs_by_id}
+        folios: Dict[str, List[entry.Entry]] = {version: [] for version in divs_by_id}
+
+        for (version, filepath), (folio, folio_entry, divs) in zip(files, loaded):
+            parse_counts[filepath] += 1
+            profiler.count("files parsed")
+            logger.debug("Loaded folio %s from file %s...", folio, filepath)
+            folios[version].append(folio_entry)
+            for identity, list_of_divs in divs.items():
+                if identity in divs_by_id[version]:
+                    divs_by_id[version][identity].extend(list_of_divs)
+                elif identity: # Only keep divs with an ID.
+                    divs_by_id[version][identity] = list_of_divs
+                    folios_by_id[version][identity] = folio
+
+        jobs = [(version, (b"<entry>" + b"".join(list_of_divs) + b"</entry>", folios_by_id[version][identity], identity))
+                for version, xml_dict in divs_by_id.items() for identity, list_of_divs in xml_dict.items()]
+        chunksize = max(1, len(jobs) // (4 * workers))
+        built = executor.map(_build_entry, [args for _, args in jobs], chunksize=chunksize)
+
+        entries: Dict[str, List[entry.Entry]] = {version: [] for version in divs_by_id}
+        for (version, (_, folio, identity)), new_entry in zip(jobs, built):
+            logger.debug("Generated entry with folio %s, ID %s...", folio, identity)
+            entries[version].append(new_entry)
+
+    for version in divs_by_id:
+        entries[version].sort(key=lambda e: e.identity)
+        folios[version].sort(key=lambda e: e.folio)
+        logger.info("Generated %d entr%s for version %s.", len(entries[version]), 'y' if len(entries[version])==1 else 'ies', version)
+
+    return entries, folios
+
 class Manuscript():
     def __init__(self, entries={}, folios={}):
         """Contain dictionaries representing the manuscript's entries and folios, keyed by version, with the following schema:
@@ -130,13 +353,86 @@ class Manuscript():
         self.entries = {}
         self.folios = {}
         self.versions = []
+        self.directories = OrderedDict() # folder each version was loaded from, keyed by version, if loaded from files
+        self.sources: Dict[str, Dict[str, str]] = OrderedDict() # hash of each source file when it was loaded, keyed by version and folio, see source_hashes()
+        self.indexes: Dict[str, InvertedIndex] = {} # full-text index of each version's entries, built on the first search
+        self._property_index: PropertyIndex = None
+        self.text_stores: Dict[Tuple[str, str, str], TextStore] = {} # see compact()
         for version, list_of_entries in entries.items():
             self.add_entries(version, list_of_entries)
 
         for version, list_of_folios in folios.items():
             self.add_folios(version, list_of_folios)
 
-    # TODO: write a search method
+    def search(self, query: str, versions=None, categories=None, limit: int = None) -> List[SearchResult]:
+        """Search the text of entries, returning a list of SearchResult tuples of (version, identity, folio, score), most relevant first.
+        The query is a sequence of clauses, all of which must match, each being one of:
+            a word, e.g. `eau`
+            a prefix followed by *, e.g. `fond*`
+            a phrase in double quotes, e.g. `"eau de vie"`
+        Matching ignores case and accents. Results are ranked by BM25 relevance.
+        Optional arguments:
+            `versions`: a version or list of versions to search. Defaults to every version. Raises KeyError if one is not loaded.
+            `categories`: a category or list of categories, at least one of which an entry must have.
+            `limit`: a maximum number of results.
+        """
+        if isinstance(versions, str):
+            versions = [versions]
+        if isinstance(categories, str):
+            categories = [categories]
+
+        results = []
+        for version in (versions or self.versions):
+            entries = self.entries.get(version, {})
+            identities = None
+            if categories:
+                identities = [identity for identity, entry in entries.items() if any(category in entry.categories for category in categories)]
+            for identity, score in self.text_index(version).search(query, identities=identities):
+                results.append(SearchResult(version, identity, entries[identity].folio, score))
+
+        results.sort(key=lambda result: -result.score) # stable, so ties stay in version and entry order
+        return results[:limit] if limit is not None else results
+
+    def text_index(self, version: str) -> InvertedIndex:
+        """Return the full-text index of a version's entries, building it if needed. Raises KeyError for a version which is not loaded."""
+        if version not in self.versions:
+            raise KeyError(f"No version '{version}'. Versions: {', '.join(self.versions)}")
+        if version not in self.indexes:
+            self.indexes[version] = InvertedIndex(self.entries.get(version, {}))
+        return self.indexes[version]
+
+    def concordance(self, term: str, version="tl", width: int = 40) -> DataFrame:
+        """Return every occurrence of a word, prefix (e.g. `fond*`) or phrase in the text of a version's entries in context, ignoring case and accents.
+        Returns a DataFrame with one row per occurrence, in entry order, with the columns:
+            entry_id: the entry's ID in the standard format, e.g. p001r_1
+            folio: the entry's folio
+            left: the `width` characters before the occurrence
+            keyword: the occurrence, as written in the text
+            right: the `width` characters after the occurrence
+        Occurrences and their offsets in the text are looked up in the full-text index, so entries are neither scanned nor tokenized again.
+        """
+        entries = self.entries.get(version, {})
+        kind, words = entry.parse_term(term)
+        index = self.text_index(version)
+        matches = index.matches(kind, words) if words else {}
+
+        rows = []
+        for identity, e in entries.items():
+            if identity in matches:
+                spans = index.spans(identity, matches[identity], len(words))
+                rows.extend((display_id(identity), e.folio, left, keyword, right) for left, keyword, right in entry.in_context(e.text, spans, width=width))
+        return DataFrame(rows, columns=["entry_id", "folio", "left", "keyword", "right"])
+
+    @property
+    def property_index(self) -> PropertyIndex:
+        """Index of the property terms of every entry, built on first access, to look up which entries contain a term, and the terms of an entry, without scanning the manuscript."""
+        if self._property_index is None:
+            self._property_index = PropertyIndex(self.entries)
+        return self._property_index
+
+    def find_entries(self, prop: str, term: str, version="tl") -> Dict[str, int]:
+        """Return the number of occurrences of a verbatim term of a property (e.g. "plant", "rose") in each entry of a version which contains it, keyed by ID."""
+        return self.property_index.lookup(prop, version, term)
 
     def get_entry(self, version, identity):
         es = self.entries.get(version)
@@ -152,6 +448,8 @@ class Manuscript():
         if version not in self.entries.keys():
             self.entries[version] = OrderedDict()
         self.entries[version][clean_id(entry.identity)] = entry
+        self.indexes.pop(version, None) # rebuilt on the next search
+        self._property_index = None
 
     def add_entries(self, version, list_of_entries):
         for entry in list_of_entries:
@@ -170,181 +468,452 @@ class Manuscript():
 
     def add_dir(self, directory):
         """Add another version of the manuscript by providing a path to a folder containing XML files to be parsed as entries and folios."""
-        self.add_entries(os.path.basename(directory), generate_entries(directory))
-        self.add_folios(os.path.basename(directory), generate_folios(directory))
+        hashes = hash_dir(directory) # before parsing, so that a file changed meanwhile is seen as changed by the next update
+        sources = load_dir(directory) # parse each file once, for both entries and folios
+        self.add_entries(os.path.basename(directory), generate_entries(directory, sources))
+        self.add_folios(os.path.basename(directory), generate_folios(directory, sources))
+        self.directories[os.path.basename(directory)] = directory
+        self.sources[os.path.basename(directory)] = hashes
 
     def add_dirs(self, *directories):
         for directory in directories:
             self.add_dir(directory)
 
+    @profiler.timed("refresh")
+    def refresh(self, version: str, filepaths: List[str]) -> List[str]:
+        """Reload the given source files of a version after they were changed, added or deleted, and regenerate the folios they hold and the entries with divs in them, before or after the change.
+        Every other folio and entry is left as it is. All files are parsed before anything changes, so a file with invalid XML leaves the manuscript untouched.
+        Returns the IDs of the entries which were regenerated or removed.
+        """
+        folios = self.folios.setdefault(version, OrderedDict())
+        entries = self.entries.setdefault(version, OrderedDict())
+        hashes = [(extract_folio(filepath), hash_file(filepath) if os.path.exists(filepath) else None) for filepath in filepaths]
+        trees = [(clean_folio(extract_folio(filepath)), parse_file(filepath) if os.path.exists(filepath) else None) for filepath in filepaths]
+
+        affected = set()
+        for folio_name, tree in trees:
+            for xml in (folios[folio_name].xml if folio_name in folios else None, tree):
+                if xml is not None:
+                    affected.update(div.get("id") for div in xml.iterfind("div") if div.get("id"))
+            if tree is None:
+                folios.pop(folio_name, None)
+            else:
+                folios[folio_name] = entry.Entry(tree, folio=folio_name)
+
+        # Gather the divs of the affected entries from every folio of the version, since an entry may be continued on another folio than the one which changed.
+        xml_dict: Dict[str, et.Element] = OrderedDict()
+        folios_by_id = {}
+        for folio_name, folio in sorted(folios.items(), key=lambda i: i[0].zfill(4)): # in folio order, like the source files
+            for div in folio.xml.iterfind("div"):
+                identity = div.get("id")
+                if identity in affected:
+                    if identity not in xml_dict:
+                        xml_dict[identity] = et.Element("entry")
+                        folios_by_id[identity] = folio_name
+                    xml_dict[identity].append(deepcopy(div)) # copied, so the folio is left intact
+
+        for identity in affected:
+            if identity in xml_dict:
+                entries[clean_id(identity)] = entry.Entry(xml_dict[identity], folio=folios_by_id[identity], identity=clean_id(identity))
+            else:
+                entries.pop(clean_id(identity), None)
+
+        sources = self.sources.setdefault(version, OrderedDict())
+        for folio_name, file_hash in hashes:
+            if file_hash is None:
+                sources.pop(folio_name, None)
+            else:
+                sources[folio_name] = file_hash
+
+        # Keep the order of from_dirs(), in which derivatives are written.
+        self.entries[version] = OrderedDict(sorted(entries.items()))
+        self.folios[version] = OrderedDict(sorted(folios.items()))
+        self.sources[version] = OrderedDict(sorted(sources.items()))
+        if version not in self.versions:
+            self.versions.append(version)
+        self.indexes.pop(version, None) # rebuilt on the next search
+        self._property_index = None
+        return sorted(clean_id(identity) for identity in affected)
+
     @classmethod
     def from_dir(cls, directory):
         """Given a path to a folder with XML files for various manuscript versions, generate the manuscript using those entries and folios as inputs.
         """
-        return from_dirs(cls, [directory])
+        return cls.from_dirs(directory)
 
     @classmethod
-    def from_dirs(cls, *directories):
+    @profiler.timed("from_dirs")
+    def from_dirs(cls, *directories, workers: int = None):
         """Given any number of paths to folders with XML files for various manuscript versions, generate the manuscript using those entries and folios as inputs.
+        Optional argument `workers` is a number of processes over which to spread parsing and entry generation; by default everything is done in this process.
         """
-        print(f"Generating Manuscript object for versions {','.join([os.path.basename(directory) for directory in directories])}...")
+        logger.info("Generating Manuscript object for versions %s...", ','.join([os.path.basename(directory) for directory in directories]))
         entries = {}
         folios = {}
-        for directory in directories:
-            version = os.path.basename(directory)
-            list_of_entries = generate_entries(directory)
-            list_of_folios = generate_folios(directory)
-            entries[version] = list_of_entries
-            folios[version] = list_of_folios
-        return cls(entries, folios)
-
-    def update(self, dry_run=False):
-        self.update_metadata(dry_run=dry_run)
-        self.update_ms_txt(dry_run=dry_run)
-        self.update_entries(dry_run=dry_run)
-        self.update_all_folios(dry_run=dry_run)
-
-    def update_ms_txt(self, outdir=utils.ms_txt_path, dry_run=False):
+        hashes = OrderedDict((os.path.basename(directory), hash_dir(directory)) for directory in directories) # before parsing, as in add_dir()
+        parses_before = sum(parse_counts.values())
+        if workers and workers > 1:
+            entries, folios = generate_parallel(directories, workers=workers)
+        else:
+            for directory in directories:
+                version = os.path.basename(directory)
+                with profiler.stage(version):
+                    sources = load_dir(directory) # parse each file once, for both entries and folios
+                    list_of_entries = generate_entries(directory, sources)
+                    list_of_folios = generate_folios(directory, sources)
+                entries[version] = list_of_entries
+                folios[version] = list_of_folios
+        parses = sum(parse_counts.values()) - parses_before
+        logger.info("Parsed %d file%s for versions %s.", parses, '' if parses==1 else 's', ','.join(entries.keys()))
+        ms = cls(entries, folios)
+        ms.directories.update((os.path.basename(directory), directory) for directory in directories)
+        ms.sources.update(hashes)
+        return ms
+
+    @classmethod
+    @profiler.timed("load_cached")
+    def load_cached(cls, *directories, path: str = utils.cache_path, workers: int = None, compact: bool = False):
+        """Like from_dirs(), but keep a copy of the manuscript in a binary cache file at `path`, with every field of its entries and folios already computed.
+        If the cache was built from the same source files, stylesheet and code, it is loaded instead of parsing and rendering everything again.
+        Otherwise the manuscript is generated as usual and the cache is replaced. By default, all versions are loaded from the m-k-manuscript-data repository.
+        If `compact`, the text of the manuscript is kept in text stores in a folder named after the cache, e.g. manuscript.pickle.text (see compact()), which every process loading the cache maps instead of copying.
+        Each cache file has its own folder, so that caches of different manuscripts kept side by side do not overwrite each other's text.
+        """
+        directories = directories or utils.version_paths
+        key = dict(cache_key(directories), compact=compact)
+        ms = read_cache(path, key)
+        if ms is not None:
+            logger.info("Loaded Manuscript object for versions %s from %s.", ','.join(ms.versions), path)
+            ms.directories = OrderedDict((os.path.basename(directory), directory) for directory in directories)
+            ms.sources = OrderedDict(key["sources"])
+            return ms
+
+        ms = cls.from_dirs(*directories, workers=workers)
+        with profiler.stage("precompute"):
+            ms.precompute()
+        if compact:
+            ms.compact(os.path.abspath(path) + ".text")
+        write_cache(path, key, ms)
+        logger.info("Saved Manuscript object to %s.", path)
+        return ms
+
+    def precompute(self):
+        """Compute every field of every entry and folio now rather than on first access."""
+        for collection in (self.entries, self.folios):
+            for items in collection.values():
+                for item in items.values():
+                    item.precompute()
+        return self
+
+    @profiler.timed("compact")
+    def compact(self, directory: str = None, fields=("text", "xml_string")):
+        """Move the rendered text of every entry and folio into one TextStore per collection ("entries" or "folios"), version and field,
+        kept in `text_stores` under those three keys, so each version's text is held in one contiguous buffer rather than one string per entry and field.
+        Entries then decode their text from the store on each access (see entry.Entry.use_store()), and their raw() bytes are slices of it.
+        If `directory` is given, each store is saved there as e.g. entries_tl_text.bin and memory-mapped. A manuscript pickled after that,
+        e.g. by load_cached() or to send to worker processes, refers to the files rather than copying the text, so every process shares the same pages.
+        """
+        for kind, collection in (("entries", self.entries), ("folios", self.folios)):
+            for version, items in collection.items():
+                for field in fields:
+                    store = TextStore.from_texts((key, getattr(item, field)) for key, item in items.items())
+                    if directory:
+                        path = os.path.join(directory, f"{kind}_{version}_{field}.bin")
+                        store.save(path)
+                        store = TextStore.load(path)
+                    for key, item in items.items():
+                        item.use_store(field, store, key)
+                    self.text_stores[(kind, version, field)] = store
+        logger.info("Compacted %d text stores, %d bytes.", len(self.text_stores), sum(store.nbytes for store in self.text_stores.values()))
+        return self
+
+    def source_hashes(self) -> Dict[str, Dict[str, str]]:
+        """Return a hash of each source file, keyed by version and folio, for the versions which were loaded from files.
+        The files are hashed when they are loaded (or reloaded by refresh()) rather than now, so the hashes recorded in manifests are those of the sources the derivatives were generated from,
+        even if a file changes during an update.
+        """
+        return self.sources
+
+    def update(self, dry_run=False, incremental=False, write_workers=1):
+        self.update_metadata(dry_run=dry_run, incremental=incremental)
+        self.update_ms_txt(dry_run=dry_run, incremental=incremental, write_workers=write_workers)
+        self.update_entries(dry_run=dry_run, incremental=incremental, write_workers=write_workers)
+        self.update_all_folios(dry_run=dry_run, incremental=incremental)
+
+    def plan(self, outdir, fingerprints, incremental=False) -> Tuple[Manifest, List[str], List[str]]:
+        """Decide which units of a derivative folder must be written, given the current fingerprint of each unit.
+        Returns a tuple of the folder's manifest, the units to write, and the units which no longer exist.
+        In incremental mode, with a valid manifest, only new or changed units are written. Otherwise every unit is written.
+        """
+        manifest = Manifest(outdir)
+        if incremental and manifest.valid:
+            stale, removed = manifest.diff(fingerprints)
+        else:
+            stale, removed = list(fingerprints.keys()), []
+        logger.info("Updating %d of %d unit%s in %s, %d removed...", len(stale), len(fingerprints), '' if len(fingerprints)==1 else 's', outdir, len(removed))
+        return manifest, stale, removed
+
+    @profiler.timed("update_ms_txt")
+    def update_ms_txt(self, outdir=utils.ms_txt_path, dry_run=False, incremental=False, write_workers=1) -> OutputWriter:
         """Update  with the current manuscript from /ms-xml/.
         Iterate through /ms-xml/ for each version, remove tags, and save to /ms-txt/.
+        If `incremental`, only render the folios whose content changed since the last update, according to the manifest in `outdir`.
+        Files are only written if their content changed, and files no longer generated are removed. Returns the OutputWriter used, which counts them.
+        Optional argument `write_workers` is a number of threads with which to write files concurrently.
         """
-        if not dry_run:
+        writer = OutputWriter(dry_run=dry_run, workers=write_workers)
+        fingerprints = OrderedDict((f"{version}/{folio_name}", folio.digest) for version, folios_dict in self.folios.items() for folio_name, folio in folios_dict.items())
+        manifest, stale, _ = self.plan(outdir, fingerprints, incremental=incremental)
+        stale = set(stale)
+
+        with writer:
+            for version, folios_dict in self.folios.items():
+                with profiler.stage(version):
+                    for folio_name, folio in folios_dict.items():
+                        outpath = os.path.join(outdir, version, filename_from_folio(folio_name, version, "txt"))
+                        if f"{version}/{folio_name}" in stale or not os.path.exists(outpath): # also rewrite files deleted since the last update
+                            writer.write(outpath, folio.text)
+                        else:
+                            writer.keep(outpath)
+
             for version in utils.versions:
-                shutil.rmtree(os.path.join(outdir, version))
+                writer.remove_orphans(os.path.join(outdir, version))
 
-        for version, folios_dict in self.folios.items():
-            for folio_name, folio in folios_dict.items():
-                outpath = os.path.join(outdir, version, filename_from_folio(folio_name, version, "txt"))
-                if not dry_run:
-                    os.makedirs(os.path.dirname(outpath), exist_ok=True)
-                if dry_run:
-                    outpath = os.devnull
-                with open(outpath, 'w') as fp:
-                    print(f"Writing folio {version}_{folio_name} to {ignore_data_path(outpath)}...")
-                    fp.write(folio.text)
+        logger.info("Updated ms-txt: %s.", writer.summary())
+        if not dry_run:
+            manifest.save(fingerprints, self.source_hashes(), writer.paths)
+        return writer
+
+    @profiler.timed("update_entries")
+    def update_entries(self, outdir=utils.entries_path, dry_run=False, incremental=False, write_workers=1) -> OutputWriter:
+        """Update /m-k-manuscript-data/entries/ with the current manuscript from /ms-xml/.
+        If `incremental`, only render the entries whose content changed since the last update, according to the manifest in `outdir`.
+        Entries continued across several folios are compared as a whole, so a change in any of their divs rewrites them.
+        Files are only written if their content changed, and files no longer generated are removed. Returns the OutputWriter used, which counts them.
+        Optional argument `write_workers` is a number of threads with which to write files concurrently.
+        """
+        writer = OutputWriter(dry_run=dry_run, workers=write_workers)
+        txt_dir = os.path.join(outdir, "txt")
+        xml_dir = os.path.join(outdir, "xml")
 
+        fingerprints = OrderedDict((f"{version}/{identity}", entry.digest) for version, entries in self.entries.items() for identity, entry in entries.items())
+        manifest, stale, _ = self.plan(outdir, fingerprints, incremental=incremental)
+        stale = set(stale)
 
-    def update_entries(self, outdir=utils.entries_path, dry_run=False):
-        """Update /m-k-manuscript-data/entries/ with the current manuscript from /ms-xml/."""
+        with writer:
+            for version, entries in self.entries.items():
+                with profiler.stage(version):
+                    txt_path = os.path.join(txt_dir, version)
+                    xml_path = os.path.join(xml_dir, version)
 
-        txt_dir = os.path.join(outdir, "txt")
-        xml_dir = os.path.join(outdir, "xml")
+                    for identity, entry in entries.items():
+                        # need to leftpad this
+                        filepath_txt = os.path.join(txt_path, f'{version}_{display_id(entry.identity)}.txt')
+                        filepath_xml = os.path.join(xml_path, f'{version}_{display_id(entry.identity)}.xml')
+
+                        if f"{version}/{identity}" in stale or not (os.path.exists(filepath_txt) and os.path.exists(filepath_xml)): # also rewrite files deleted since the last update
+                            writer.write(filepath_txt, entry.text)
+                            writer.write(filepath_xml, entry.xml_string) # should already have an <entry> root tag :)
+                        else:
+                            writer.keep(filepath_txt)
+                            writer.keep(filepath_xml)
 
+            writer.remove_orphans(txt_dir)
+            writer.remove_orphans(xml_dir)
+
+        logger.info("Updated entries: %s.", writer.summary())
         if not dry_run:
-            shutil.rmtree(txt_dir)
-            shutil.rmtree(xml_dir)
-
-        for version, entries in self.entries.items():
-            txt_path = os.path.join(txt_dir, version)
-            xml_path = os.path.join(xml_dir, version)
-            if not dry_run:
-                os.makedirs(txt_path, exist_ok=True)
-                os.makedirs(xml_path, exist_ok=True)
-
-            for identity, entry in entries.items():
-                # need to leftpad this
-                filepath_txt = os.path.join(txt_path, f'{version}_{display_id(entry.identity)}.txt')
-                filepath_xml = os.path.join(xml_path, f'{version}_{display_id(entry.identity)}.xml')
-
-                content_txt = entry.text
-                content_xml = entry.xml_string # should already have an <entry> root tag :)
-
-                if dry_run:
-                    filepath_txt = os.devnull
-                with open(filepath_txt, 'w', encoding='utf-8') as fp:
-                    print(f"Writing entry {entry.identity} {version} txt to {ignore_data_path(filepath_txt)}...")
-                    fp.write(content_txt)
-
-                if dry_run:
-                    filepath_xml = os.devnull
-                with open(filepath_xml, 'w', encoding='utf-8') as fp:
-                    print(f"Writing entry {entry.identity} {version} xml to {ignore_data_path(filepath_xml)}...")
-                    fp.write(content_xml)
-
-    def update_all_folios(self, outdir=utils.all_folios_path, dry_run=False):
-        """Update /m-k-manuscript-data/allFolios/ with the current manuscript from /ms-xml/."""
+            manifest.save(fingerprints, self.source_hashes(), writer.paths)
+        return writer
+
+    @profiler.timed("update_all_folios")
+    def update_all_folios(self, outdir=utils.all_folios_path, dry_run=False, incremental=False) -> OutputWriter:
+        """Update /m-k-manuscript-data/allFolios/ with the current manuscript from /ms-xml/.
+        If `incremental`, only regenerate the versions in which a folio changed since the last update, according to the manifest in `outdir`.
+        Files are only written if their content changed, and files no longer generated are removed. Returns the OutputWriter used, which counts them.
+        """
+        writer = OutputWriter(dry_run=dry_run)
         txt_dir = os.path.join(outdir, "txt")
         xml_dir = os.path.join(outdir, "xml")
 
-        if not dry_run:
-            shutil.rmtree(txt_dir)
-            shutil.rmtree(xml_dir)
+        fingerprints = OrderedDict((version, hash_bytes("".join(folio.digest for folio in self.folios[version].values()).encode())) for version in self.versions)
+        manifest, stale, _ = self.plan(outdir, fingerprints, incremental=incremental)
 
         for version in self.versions:
-            content_txt = self.generate_all_folios(method="txt", version=version)
-            content_xml = self.generate_all_folios(method="xml", version=version)
-
-            txt_path = os.path.join(txt_dir, version)
-            xml_path = os.path.join(xml_dir, version)
-            if not dry_run:
-                os.makedirs(txt_path, exist_ok=True)
-                os.makedirs(xml_path, exist_ok=True)
-
-            filepath_txt = os.path.join(txt_path, f"all_{version}.txt")
-            filepath_xml = os.path.join(xml_path, f"all_{version}.xml")
-
-            if dry_run:
-                filepath_txt = os.devnull
-            with open(filepath_txt, 'w', encoding='utf-8') as fp:
-                print(f"Writing allFolios {version} txt to {ignore_data_path(filepath_txt)}...")
-                fp.write(content_txt)
-
-            if dry_run:
-                filepath_xml = os.devnull
-            with open(filepath_xml, 'w', encoding='utf-8') as fp:
-                print(f"Writing allFolios {version} xml to {ignore_data_path(filepath_xml)}...")
-                fp.write(content_xml)
-
-    def generate_all_folios(self, method="txt", version="tl"):
+            filepath_txt = os.path.join(txt_dir, version, f"all_{version}.txt")
+            filepath_xml = os.path.join(xml_dir, version, f"all_{version}.xml")
+
+            if version in stale or not (os.path.exists(filepath_txt) and os.path.exists(filepath_xml)): # also rewrite files deleted since the last update
+                for method, filepath in (("txt", filepath_txt), ("xml", filepath_xml)):
+                    with profiler.stage(f"{version}/{method}"), writer.stream(filepath) as fp:
+                        self.write_all_folios(fp, method=method, version=version)
+            else:
+                writer.keep(filepath_txt)
+                writer.keep(filepath_xml)
+
+        writer.remove_orphans(txt_dir)
+        writer.remove_orphans(xml_dir)
+
+        logger.info("Updated allFolios: %s.", writer.summary())
+        if not dry_run:
+            manifest.save(fingerprints, self.source_hashes(), writer.paths)
+        return writer
+
+    def generate_all_folios(self, method="txt", version="tl") -> str:
         """Generate a single txt or xml file containing the content of each file (i.e. folio) of a given version in sequence.
         `method` may be "txt" or "xml".
+        To write it to a file without holding the whole content in memory, use write_all_folios() instead.
         """
-        if method=="txt":
-            content = "" # string representing the entire text version
-            for folio_name, folio in sorted(self.folios[version].items(), key=lambda i: i[0].zfill(4)):
-                print(f"Adding folio {folio_name} to allFolios {version} {method}...")
-                content += folio.text + "\n\n"
-
-        elif method=="xml":
-            root = et.Element("all") # Create a root element to wrap the entire XML.
-            for folio_name, folio in sorted(self.folios[version].items(), key=lambda i: i[0].zfill(4)):
-                print(f"Adding folio {folio_name} to allFolios {version} {method}...")
-                list_of_divs = folio.xml.findall("div")
-                divs = [deepcopy(div) for div in list_of_divs] # Lxml modifies in-place when you move divs, so deepcopy makes a copy of the folio so we don't lose data in self.folios.
-                root.extend(divs) # Add children of <entry> element.
-            content = entry.to_xml_string(root)
+        buffer = BytesIO()
+        self.write_all_folios(buffer, method=method, version=version)
+        return buffer.getvalue().decode("utf-8")
 
-        else:
+    def write_all_folios(self, fp: BinaryIO, method="txt", version="tl") -> None:
+        """Write the content of each folio of a given version in sequence to the binary file object `fp`, encoded as utf-8, one folio at a time.
+        `method` may be "txt" or "xml". The xml is serialized incrementally under an <all> root element, without copying the folios.
+        """
+        if method not in ("txt", "xml"):
             raise Exception(f"Invalid method: '{method}'. Methods: txt, xml")
+        folios = sorted(self.folios[version].items(), key=lambda i: i[0].zfill(4))
 
-        return content
+        if method=="txt":
+            for folio_name, folio in folios:
+                logger.debug("Adding folio %s to allFolios %s %s...", folio_name, version, method)
+                fp.write((folio.text + "\n\n").encode("utf-8"))
 
-    def update_metadata(self, outdir=utils.metadata_path, outfile="entry_metadata.csv", dry_run=False):
-        """Write a metadata file containing information about each entry."""
-        df = self.generate_metadata()
-        df.drop(columns=self.versions, inplace=True) # this is just memory addresses
+        else:
+            with et.xmlfile(fp, encoding="utf-8") as xf:
+                with xf.element("all"): # Create a root element to wrap the entire XML.
+                    for folio_name, folio in folios:
+                        logger.debug("Adding folio %s to allFolios %s %s...", folio_name, version, method)
+                        for div in folio.xml.iterfind("div"): # Children of <entry> are written out in place, so self.folios is left untouched.
+                            xf.write(div)
+                        xf.flush()
+
+    @profiler.timed("update_metadata")
+    def update_metadata(self, outdir=utils.metadata_path, outfile="entry_metadata.csv", dry_run=False, incremental=False) -> OutputWriter:
+        """Write a metadata file containing information about each entry.
+        If `incremental`, only regenerate the rows of entries which changed in any version since the last update, according to the manifest in `outdir`, and reuse the other rows from the existing file.
+        The file is only written if its content changed. Returns the OutputWriter used.
+        """
+        writer = OutputWriter(dry_run=dry_run)
         outpath = os.path.join(outdir, outfile)
-        if dry_run:
-            outpath = os.devnull
-        print(f"Writing metadata to {ignore_data_path(outpath)}...")
-        df.to_csv(outpath, index=False)
+        identities = list(self.entries["tl"].keys()) if "tl" in self.versions else []
+        fingerprints = OrderedDict((display_id(identity), hash_bytes("".join(f"{version}={es[identity].digest if identity in es else ''};" for version, es in self.entries.items()).encode())) for identity in identities)
+        manifest, stale, removed = self.plan(outdir, fingerprints, incremental=incremental)
+
+        df = None
+        if incremental and manifest.valid and os.path.exists(outpath):
+            if not stale and not removed:
+                writer.keep(outpath)
+                if not dry_run:
+                    manifest.save(fingerprints, self.source_hashes(), writer.paths) # record the new source hashes even if no row changed
+                return writer
 
-    def generate_metadata(self):
-        """Create a Pandas DataFrame indexed by entry containing metadata about the manuscript."""
-        print("Generating metadata...")
+            # Reuse the existing rows of entries which did not change.
+            with open(outpath, 'r', encoding='utf-8', newline='') as fp:
+                header, *rows = list(csv.reader(fp))
+            old_rows = {row[header.index("div_id")]: row for row in rows} if "div_id" in header else {}
+
+            new_df = self.generate_metadata(identities=[identity for identity in identities if display_id(identity) in stale])
+            new_header, *new_rows = list(csv.reader(StringIO(new_df.to_csv(index=False))))
+            new_rows = {row[new_header.index("div_id")]: row for row in new_rows}
+
+            merged = [new_rows.get(div_id) or old_rows.get(div_id) for div_id in fingerprints.keys()]
+            if new_header == header and all(merged): # otherwise the columns changed or the file was edited, so regenerate every row
+                df = DataFrame(merged, columns=header)
+
+        if df is None:
+            df = self.generate_metadata()
+
+        logger.info("Writing metadata to %s...", outpath)
+        writer.write(outpath, df.to_csv(index=False))
+
+        logger.info("Updated metadata: %s.", writer.summary())
+        if not dry_run:
+            manifest.save(fingerprints, self.source_hashes(), writer.paths)
+        return writer
+
+    @profiler.timed("generate_metadata")
+    def generate_metadata(self, identities=None) -> DataFrame:
+        """Create a Pandas DataFrame indexed by entry containing metadata about the manuscript, with one column of strings per field.
+        Every column is filled in a single pass over the entries, and the DataFrame is created once at the end.
+        Optional argument `identities` restricts the DataFrame to the entries with those IDs.
+        An entry missing from a version other than TL, e.g. while it is being added, gets empty cells for that version.
+        """
+        logger.info("Generating metadata...")
 
         if ("tl" not in self.versions):
             raise Exception(f"Metadata not available: TL version not loaded.")
 
-        df = DataFrame(self.entries)
-        df['folio'] = df.tl.apply(lambda x: x.folio.zfill(4)) # Add back leading zeros.
-        df['folio_display'] = df.tl.apply(lambda x: x.folio)
-        df['div_id'] = df.tl.apply(lambda x: "p" + x.identity[:-1].zfill(4) + "_" + x.identity[-1]) # Use the standard ID formatting.
-        df['categories'] = df.tl.apply(lambda x: (';'.join(x.categories)))
-        for version in self.versions:
-            df[f'heading_{version}'] = df[version].apply(lambda x: x.title)
+        tl_entries = self.entries["tl"]
+        identities = list(tl_entries.keys()) if identities is None else [identity for identity in identities if identity in tl_entries]
+
+        columns: Dict[str, List[str]] = OrderedDict((name, []) for name in ("folio", "folio_display", "div_id", "categories"))
+        headings = [(self.entries[version], columns.setdefault(f'heading_{version}', [])) for version in self.versions]
         for prop, tag in utils.prop_dict.items():
             for version in self.versions:
-                df[f'{tag}_{version}'] = df[version].apply(lambda x: ';'.join(x.properties[prop]))
-
-        return df
+                columns[f'{tag}_{version}'] = []
+        # For each version, the column of each property, so a row is filled without looking up column names.
+        prop_columns = [(self.entries[version], [(prop, columns[f'{tag}_{version}']) for prop, tag in utils.prop_dict.items()]) for version in self.versions]
+
+        for identity in identities:
+            tl = tl_entries[identity]
+            columns["folio"].append(tl.folio.zfill(4)) # Add back leading zeros.
+            columns["folio_display"].append(tl.folio)
+            columns["div_id"].append("p" + tl.identity[:-1].zfill(4) + "_" + tl.identity[-1]) # Use the standard ID formatting.
+            columns["categories"].append(';'.join(tl.categories))
+            for entries, column in headings:
+                column.append(entries[identity].title if identity in entries else "")
+            for entries, prop_column_list in prop_columns:
+                properties = entries[identity].properties if identity in entries else {}
+                for prop, column in prop_column_list:
+                    column.append(';'.join(properties.get(prop, ())))
+
+        return DataFrame(columns, index=identities)
+
+    def count_properties(self) -> Tuple[List[str], List[str], np.ndarray]:
+        """Count the terms of each property in each entry of each version.
+        Returns a tuple of the IDs of the entries (those of the TL version), the tags of the properties, and an array of counts of shape (entries, properties, versions), with versions in the order of self.versions.
+        An entry missing from a version counts as having no terms in it.
+        """
+        if ("tl" not in self.versions):
+            raise Exception(f"Property counts not available: TL version not loaded.")
+
+        identities = list(self.entries["tl"].keys())
+        tags = list(utils.prop_dict.values())
+        no_terms = [0] * len(tags)
+        counts = np.array([
+            [[len(terms) for terms in es[identity].properties.values()] if identity in es else no_terms for identity in identities]
+            for es in (self.entries[version] for version in self.versions)
+        ], dtype=np.int32).reshape(len(self.versions), len(identities), len(tags))
+        return identities, tags, counts.transpose(1, 2, 0)
+
+    def check_property_counts(self) -> DataFrame:
+        """Compare the number of terms of each property across versions, for each entry.
+        Returns a DataFrame with one row for each property of each entry whose count is not the same in every version, in entry order, with the following columns:
+            entry_id: the entry's ID in the standard format, e.g. p001r_1
+            prop: the property's tag
+            counts: list of the number of terms in each version
+            <version>: terms in that version, separated by semicolons, for each version
+            spread: difference between the highest and lowest count
+        """
+        identities, tags, counts = self.count_properties()
+        spreads = counts.max(axis=2) - counts.min(axis=2)
+        rows, columns = np.nonzero(spreads) # mismatches, in entry order, then property order
+        props = list(utils.prop_dict.keys())
+
+        report = OrderedDict()
+        report["entry_id"] = [display_id(identities[row]) for row in rows]
+        report["prop"] = [tags[column] for column in columns]
+        report["counts"] = counts[rows, columns].tolist()
+        for version in self.versions:
+            es = self.entries[version]
+            report[version] = [';'.join(es[identities[row]].properties[props[column]]) if identities[row] in es else '' for row, column in zip(rows, columns)]
+        report["spread"] = spreads[rows, columns]
+        return DataFrame(report, columns=list(report.keys()))
+
+def spread_buckets(spreads) -> Dict[str, int]:
+    """Given the spreads of property count mismatches, e.g. the spread column of Manuscript.check_property_counts(), return how many mismatches are off by 1, 2, 3 and more than 3."""
+    buckets = np.bincount(np.clip(np.asarray(spreads, dtype=np.int64), 0, 4), minlength=5)
+    return OrderedDict([("1", int(buckets[1])), ("2", int(buckets[2])), ("3", int(buckets[3])), (">3", int(buckets[4]))])
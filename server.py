@@ -0,0 +1,233 @@
+"""Serve a Manuscript over HTTP as JSON, so tools can look up entries, folios and metadata without loading the corpus themselves.
+The manuscript is loaded once, with Manuscript.load_cached(), and responses are cached and carry ETags, so repeated requests are answered from memory.
+
+Routes, for GET and HEAD requests:
+    /versions                               number of entries and folios of each version
+    /entries/<version>                      ID, folio and title of each entry of a version
+    /entries/<version>/<id>                 every field of an entry
+    /entries/<version>/<id>/text            rendered text of an entry, as plain text
+    /entries/<version>/<id>/properties      property terms of an entry
+    /folios/<version>                       name of each folio of a version
+    /folios/<version>/<folio>               text and XML of a folio
+    /folios/<version>/<folio>/text          rendered text of a folio, as plain text
+    /metadata/<id>                          metadata row of an entry, as in entry_metadata.csv
+    /search?q=<query>[&version=...][&category=...][&limit=...]   see Manuscript.search()
+Entry IDs may be written as in file names (p005r_2) or as in the Manuscript (5r2), and folios with or without leading zeros.
+"""
+from typing import Dict, List, Tuple, Optional
+import os
+import json
+import asyncio
+import logging
+import argparse
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs, unquote
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+from manifest import hash_bytes
+from manuscript import Manuscript, display_id
+
+logger = logging.getLogger(__name__)
+
+class HTTPError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        """Raised by a route to answer with an error status and a JSON message."""
+        self.status = status
+        super().__init__(message)
+
+class ResponseCache():
+    def __init__(self, maxsize: int):
+        """Bounded cache of responses, as (content type, body, ETag) tuples keyed by request target, which evicts the least recently used response when full."""
+        self.maxsize = maxsize
+        self.items: OrderedDict = OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[str, bytes, str]]:
+        response = self.items.get(key)
+        if response is not None:
+            self.items.move_to_end(key)
+        return response
+
+    def put(self, key: str, response: Tuple[str, bytes, str]) -> None:
+        self.items[key] = response
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+class ManuscriptServer():
+    def __init__(self, ms: Manuscript, cache_size: int = 4096):
+        """Answer HTTP requests about the manuscript `ms`.
+        Each response is cached, keyed by path and query, with an ETag made from a hash of its content, so that clients can revalidate with If-None-Match.
+        Connections are handled concurrently by the event loop. Responses which are not cached yet are computed in a single background thread,
+        since entries compute their fields lazily and are not safe to share between threads, and simultaneous requests for the same response wait for the same computation.
+        """
+        self.ms = ms
+        self.cache = ResponseCache(cache_size)
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def route(self, path: str, query: Dict[str, List[str]]) -> Tuple[str, bytes]:
+        """Return the content type and body of the response to a path and its parsed query string, or raise HTTPError."""
+        parts = [unquote(part) for part in path.split("/") if part]
+        ms = self.ms
+        if parts == ["versions"]:
+            return self.json({version: {"entries": len(ms.entries.get(version, {})), "folios": len(ms.folios.get(version, {}))} for version in ms.versions})
+
+        if parts[:1] == ["entries"] and len(parts) == 2:
+            return self.json([{"id": display_id(identity), "folio": e.folio, "title": e.title} for identity, e in self.collection(ms.entries, parts[1]).items()])
+        if parts[:1] == ["entries"] and len(parts) in (3, 4):
+            e = ms.get_entry(parts[1], parts[2])
+            if not e:
+                raise HTTPError(HTTPStatus.NOT_FOUND, f"No entry {parts[2]} in version {parts[1]}")
+            if len(parts) == 3:
+                return self.json({"id": display_id(e.identity), "folio": e.folio, "title": e.title, "categories": e.categories, "properties": e.properties, "text": e.text, "xml": e.xml_string})
+            if parts[3] == "text":
+                return "text/plain; charset=utf-8", e.text.encode("utf-8")
+            if parts[3] == "properties":
+                return self.json(e.properties)
+
+        if parts[:1] == ["folios"] and len(parts) == 2:
+            return self.json(list(self.collection(ms.folios, parts[1]).keys()))
+        if parts[:1] == ["folios"] and len(parts) in (3, 4):
+            folio = ms.get_folio(parts[1], parts[2])
+            if not folio:
+                raise HTTPError(HTTPStatus.NOT_FOUND, f"No folio {parts[2]} in version {parts[1]}")
+            if len(parts) == 3:
+                return self.json({"folio": folio.folio, "text": folio.text, "xml": folio.xml_string})
+            if parts[3] == "text":
+                return "text/plain; charset=utf-8", folio.text.encode("utf-8")
+
+        if parts[:1] == ["metadata"] and len(parts) == 2:
+            e = ms.get_entry("tl", parts[1])
+            if not e: # an entry missing from another version gets empty fields for it, as in entry_metadata.csv
+                raise HTTPError(HTTPStatus.NOT_FOUND, f"No metadata for entry {parts[1]}")
+            row = ms.generate_metadata(identities=[e.identity]).iloc[0]
+            return self.json(row.to_dict())
+
+        if parts == ["search"]:
+            if not query.get("q"):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing query parameter q")
+            try:
+                limit = int(query["limit"][0]) if "limit" in query else None
+            except ValueError:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Parameter limit must be an integer")
+            for version in query.get("version", []):
+                self.collection(ms.entries, version) # unknown versions are an error, not an empty search
+            results = ms.search(query["q"][0], versions=query.get("version"), categories=query.get("category"), limit=limit)
+            return self.json([{"version": r.version, "id": display_id(r.identity), "folio": r.folio, "score": r.score} for r in results])
+
+        raise HTTPError(HTTPStatus.NOT_FOUND, f"No such resource: {path}")
+
+    @staticmethod
+    def collection(collections: Dict[str, Dict], version: str) -> Dict:
+        if version not in collections:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"No version {version}")
+        return collections[version]
+
+    @staticmethod
+    def json(data) -> Tuple[str, bytes]:
+        return "application/json; charset=utf-8", json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+    async def respond(self, method: str, target: str, headers: Dict[str, str]) -> Tuple[HTTPStatus, Dict[str, str], bytes]:
+        """Return the status, headers and body of the response to a request."""
+        if method not in ("GET", "HEAD"):
+            return self.error(HTTPStatus.METHOD_NOT_ALLOWED, f"Method not allowed: {method}", {"Allow": "GET, HEAD"})
+
+        url = urlsplit(target)
+        key = f"{url.path}?{url.query}"
+        cached = self.cache.get(key)
+        if cached is None:
+            if key not in self.pending: # otherwise the same response is already being computed
+                self.pending[key] = asyncio.get_running_loop().run_in_executor(self.executor, self.route, url.path, parse_qs(url.query))
+            future = self.pending[key]
+            try:
+                content_type, body = await future
+            except HTTPError as error:
+                return self.error(error.status, str(error))
+            except Exception:
+                logger.exception("Failed to answer %s", target)
+                return self.error(HTTPStatus.INTERNAL_SERVER_ERROR, "Internal server error")
+            finally:
+                if self.pending.get(key) is future:
+                    del self.pending[key]
+            cached = (content_type, body, f'"{hash_bytes(body)}"')
+            self.cache.put(key, cached)
+
+        content_type, body, etag = cached
+        if etag in (tag.strip() for tag in headers.get("if-none-match", "").split(",")):
+            return HTTPStatus.NOT_MODIFIED, {"ETag": etag}, b""
+        return HTTPStatus.OK, {"Content-Type": content_type, "ETag": etag}, body
+
+    @staticmethod
+    def error(status: HTTPStatus, message: str, headers: Dict[str, str] = None) -> Tuple[HTTPStatus, Dict[str, str], bytes]:
+        return status, dict(headers or {}, **{"Content-Type": "application/json; charset=utf-8"}), json.dumps({"error": message}).encode("utf-8")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serve the requests of one connection, keeping it open between requests unless the client asks otherwise."""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError): # connection closed, or headers too long
+                    break
+                request_line, *header_lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+                headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(":") for line in header_lines)}
+                try:
+                    method, target, version = request_line.split(" ")
+                except ValueError:
+                    status, response_headers, body = self.error(HTTPStatus.BAD_REQUEST, "Malformed request line")
+                    method, target, version = "GET", "", "HTTP/1.0"
+                else:
+                    if headers.get("content-length", "0").isdigit():
+                        await reader.readexactly(int(headers.get("content-length", "0"))) # skip any body, which no route uses
+                    status, response_headers, body = await self.respond(method, target, headers)
+                logger.info("%s %s %d", method, target, status)
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                response_headers["Content-Length"] = str(len(body))
+                response_headers["Connection"] = "keep-alive" if keep_alive else "close"
+                writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\n".encode("latin-1"))
+                writer.write("".join(f"{name}: {value}\r\n" for name, value in response_headers.items()).encode("latin-1") + b"\r\n")
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000, backlog: int = 1024) -> asyncio.AbstractServer:
+        """Start listening, and return the asyncio server. Use port 0 to pick any free port, e.g. in tests.
+        `backlog` is the number of connections which may wait to be accepted; asyncio's default of 100 makes bursts of clients wait for the operating system to retry.
+        """
+        return await asyncio.start_server(self.handle, host, port, backlog=backlog)
+
+async def serve(ms: Manuscript, host: str = "127.0.0.1", port: int = 8000) -> None:
+    """Serve the manuscript until interrupted."""
+    manuscript_server = ManuscriptServer(ms)
+    server = await manuscript_server.start(host, port)
+    host, port = server.sockets[0].getsockname()[:2]
+    print(f"Serving versions {','.join(ms.versions)} on http://{host}:{port}/")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        manuscript_server.executor.shutdown(wait=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve entries, folios, metadata and search of the manuscript as JSON over HTTP.")
+    parser.add_argument('-H', '--host', default="127.0.0.1", help="Address to listen on. Defaults to 127.0.0.1, i.e. only this computer.")
+    parser.add_argument('-p', '--port', type=int, default=8000, help="Port to listen on. Defaults to 8000.")
+    parser.add_argument('-v', '--verbose', help="Log each request to stdout.", action="store_true")
+    parser.add_argument("path", nargs="?", default=utils.manuscript_data_path, help="Path to m-k-manuscript-data directory. Defaults to the sibling of your current directory.")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+
+    ms = Manuscript.load_cached(*[os.path.join(args.path, "ms-xml", version) for version in utils.versions])
+    try:
+        asyncio.run(serve(ms, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,82 @@
+"""Generate synthetic ms-xml folders, shaped like the real manuscript but at any scale, for benchmarks.
+The text is random, but the markup covers what the pipeline handles: every property tag of utils.prop_dict (sometimes nested), every editorial tag,
+headings, categories, entries continued on the next folio, comments, figures and escaped characters.
+Each version gets the same folios and entries, with slightly different text.
+"""
+import os
+import random
+import argparse
+from xml.sax.saxutils import escape
+
+import entry
+import utils
+
+folios_per_scale = 170 # the real manuscript has about 170 leaves, i.e. 340 folio sides, and about 900 entries
+words = "le la de et pour sable eau fer cuivre moule fondre verre terre feu plomb huile cire métal étain mortier poudre chaux vinaigre sel gomme".split()
+property_tags = list(utils.prop_dict.values())
+editorial_tags = list(entry.editorial_tags.keys()) + ["add"]
+
+def phrase(rng: random.Random, n: int = None) -> str:
+    return " ".join(rng.choice(words) for _ in range(n or rng.randint(1, 3)))
+
+def inline(rng: random.Random, depth: int = 0) -> str:
+    """Return a random piece of mixed content: plain words, a property tag (possibly nesting more markup), an editorial tag, a comment or a figure."""
+    k = rng.random()
+    if k < 0.35:
+        tag = rng.choice(property_tags)
+        inner = phrase(rng) if depth > 1 or rng.random() < 0.7 else phrase(rng, 1) + " " + inline(rng, depth + 1)
+        return f"<{tag}>{inner}</{tag}>"
+    if k < 0.5:
+        tag = rng.choice(editorial_tags)
+        if tag == "ill":
+            return "<ill/>" if rng.random() < 0.5 else "<ill>xx</ill>"
+        return f"<{tag}>{phrase(rng, 1)}</{tag}>"
+    if k < 0.53:
+        return "<!-- note --> " + phrase(rng, 1)
+    if k < 0.56:
+        return '<figure size="small"/>'
+    return escape(phrase(rng)) + (" &amp; " if rng.random() < 0.1 else "")
+
+def paragraph(rng: random.Random) -> str:
+    return " ".join(inline(rng) for _ in range(rng.randint(3, 12)))
+
+def folio_names(n_folios: int):
+    """Return the names of both sides of `n_folios` leaves, zero-padded so that sorting by filename still sorts by folio, e.g. 001r, 001v, ..."""
+    digits = max(3, len(str(n_folios)))
+    return [f"{i:0{digits}d}{side}" for i in range(1, n_folios + 1) for side in "rv"]
+
+def generate(outdir: str, scale: float = 1, seed: int = 0):
+    """Write synthetic tc, tcn and tl folders to `outdir`, with `scale` times as many folios as the real manuscript. Returns the paths of the folders."""
+    directories = []
+    for version in utils.versions:
+        rng = random.Random(seed) # same structure in every version
+        text_rng = random.Random(f"{seed}-{version}") # different text
+        directory = os.path.join(outdir, version)
+        os.makedirs(directory, exist_ok=True)
+        carry = None # continuation of the last entry of the previous folio
+        for folio in folio_names(max(1, round(folios_per_scale * scale))):
+            divs = [carry] if carry else []
+            carry = None
+            n_entries = rng.randint(1, 4)
+            for k in range(1, n_entries + 1):
+                identity = f"p{folio}_{k}"
+                categories = rng.choice([utils.categories[0], ";".join(rng.sample(utils.categories, 2)), "", None])
+                attributes = f' categories="{categories}"' if categories is not None else ""
+                head = f"<head>{phrase(text_rng)} <del>{phrase(text_rng, 1)}</del> {inline(text_rng)}</head>\n" if rng.random() < 0.8 else ""
+                body = "\n".join(f"<ab>{paragraph(text_rng)}</ab>" for _ in range(rng.randint(1, 3)))
+                divs.append(f'<div id="{identity}"{attributes}>{head}{body}\n</div>')
+                if k == n_entries and rng.random() < 0.2:
+                    carry = f'<div id="{identity}" continued="yes">\n<ab>{paragraph(text_rng)}</ab>\n</div>'
+            xml = f'<?xml version="1.0" encoding="UTF-8"?>\n<folio version="{version}" folio="{folio}">\n' + "\n".join(divs) + "\n</folio>\n"
+            with open(os.path.join(directory, f"{version}_p{folio}_preTEI.xml"), "w", encoding="utf-8") as fp:
+                fp.write(xml)
+        directories.append(directory)
+    return directories
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic ms-xml folders for benchmarks.")
+    parser.add_argument("outdir", help="Folder in which to write the tc, tcn and tl folders.")
+    parser.add_argument('-s', '--scale', type=float, default=1, help="Size relative to the real manuscript. Defaults to 1.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed. Defaults to 0.")
+    args = parser.parse_args()
+    generate(args.outdir, scale=args.scale, seed=args.seed)
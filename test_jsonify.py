@@ -0,0 +1,39 @@
+"""Tests of jsonify.py. Run with `python -m pytest`."""
+import os
+import json
+from types import SimpleNamespace
+
+import entry
+import jsonify
+from manuscript import Manuscript, clean_id, display_id
+
+committed_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "jsons", "medical.json")
+
+def test_write_json_matches_committed_layout(tmp_path, monkeypatch):
+    # Rebuild the matches of a committed file (one of those which are valid JSON) from its own records, with the titles it lists, and write them again.
+    with open(committed_path, encoding="utf-8") as fp:
+        committed = fp.read()
+    ms = Manuscript()
+    ms.entries["tl"] = {}
+    prop_dict = {}
+    for term, records in json.loads(committed).items():
+        for record in records:
+            identity = clean_id(record["entry_id"])
+            ms.entries["tl"][identity] = SimpleNamespace(title=record["entry_title"])
+            prop_dict.setdefault(term, []).append((identity, record["verbatim_term"]))
+
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("jsons")
+    jsonify.write_json(ms, prop_dict, "medical")
+    with open(os.path.join("jsons", "medical.json"), encoding="utf-8") as fp:
+        assert fp.read() == committed
+
+def test_match_terms_from_property_index():
+    ms = Manuscript()
+    for identity, body in (("10r1", "<pa>rose</pa> et <pa>roses</pa>"), ("2r1", "<pa>roses</pa>"), ("3v1", "<pa>lys</pa>"), ("3v2", "<m>rose</m>")):
+        ms.add_entry("tl", entry.Entry.from_string(f'<entry><div id="{display_id(identity)}"><ab>{body}</ab></div></entry>', identity=identity, folio=identity[:-1]))
+    rows = [{"verbatim_term": "roses", "prefLabel_en": "rose"}, {"verbatim_term": "rose", "prefLabel_en": "rose"},
+            {"verbatim_term": "lys", "prefLabel_en": "lys"}, {"verbatim_term": "tulipe", "prefLabel_en": "tulipe"}]
+    # In thesaurus order, then in folio order (2r1 before 10r1), only for terms of the property itself, without terms which match nothing.
+    assert jsonify.match_terms(ms, "plant", rows) == {"rose": [("2r1", "roses"), ("10r1", "roses"), ("10r1", "rose")], "lys": [("3v1", "lys")]}
+    assert jsonify.match_terms(ms, "material", rows) == {"rose": [("3v2", "rose")]}
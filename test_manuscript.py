@@ -0,0 +1,173 @@
+"""Tests of manuscript.py on small synthetic manuscripts, made with synthetic.py. Run with `python -m pytest`."""
+import os
+import math
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import entry
+import synthetic
+import manuscript
+from manuscript import Manuscript
+from textstore import TextStore
+
+def texts(ms: Manuscript):
+    return {(version, identity): e.text for version, entries in ms.entries.items() for identity, e in entries.items()}
+
+def test_compact_caches_side_by_side(tmp_path):
+    first = synthetic.generate(str(tmp_path / "first"), scale=0.05, seed=1)
+    second = synthetic.generate(str(tmp_path / "second"), scale=0.05, seed=2)
+    expected = texts(Manuscript.from_dirs(*first))
+
+    Manuscript.load_cached(*first, path=str(tmp_path / "cache" / "first.pickle"), compact=True)
+    Manuscript.load_cached(*second, path=str(tmp_path / "cache" / "second.pickle"), compact=True)
+    ms = Manuscript.load_cached(*first, path=str(tmp_path / "cache" / "first.pickle"), compact=True)
+    assert all(store.path.startswith(str(tmp_path / "cache" / "first.pickle.text")) for store in ms.text_stores.values())
+    assert texts(ms) == expected
+
+def test_cache_rebuilt_without_its_text_stores(tmp_path):
+    directories = synthetic.generate(str(tmp_path / "ms-xml"), scale=0.05)
+    expected = texts(Manuscript.from_dirs(*directories))
+    path = str(tmp_path / "cache" / "manuscript.pickle")
+    stores = Manuscript.load_cached(*directories, path=path, compact=True).text_stores
+
+    # A store replaced by one with the same keys but other text, e.g. by another build, would otherwise be read as if nothing changed.
+    shutil.copyfile(stores[("entries", "tc", "text")].path, stores[("entries", "tl", "text")].path)
+    assert texts(Manuscript.load_cached(*directories, path=path, compact=True)) == expected
+    os.remove(stores[("folios", "tcn", "text")].path)
+    assert texts(Manuscript.load_cached(*directories, path=path, compact=True)) == expected
+    assert texts(Manuscript.load_cached(*directories, path=path, compact=True)) == expected
+
+def test_parallel_load_matches_serial(tmp_path):
+    directories = synthetic.generate(str(tmp_path / "ms-xml"), scale=0.05)
+    serial = Manuscript.from_dirs(*directories)
+    parallel = Manuscript.from_dirs(*directories, workers=2)
+    assert texts(parallel) == texts(serial)
+    for collection in ("entries", "folios"):
+        for version, items in getattr(serial, collection).items():
+            for key, item in items.items():
+                other = getattr(parallel, collection)[version][key]
+                assert not hasattr(other, "_xml") # not reparsed, since nothing read it yet
+                for field in ("digest",) + entry.Entry.fields[1:]:
+                    assert getattr(other, field) == getattr(item, field)
+
+def test_concordance_matches_entry_context(tmp_path):
+    directories = synthetic.generate(str(tmp_path / "ms-xml"), scale=0.05)
+    ms = Manuscript.from_dirs(*directories)
+    for term in ("eau", "fond*", "eau de", "métal", "absent"):
+        rows = ms.concordance(term, width=20)
+        expected = [(e.folio, left, keyword, right) for e in ms.entries["tl"].values() for left, keyword, right in e.context(term, width=20)]
+        assert list(zip(rows.folio, rows.left, rows.keyword, rows.right)) == expected
+
+def test_write_cache_cleans_up_and_does_not_share_temp_files(tmp_path):
+    directories = synthetic.generate(str(tmp_path / "ms-xml"), scale=0.05)
+    ms = Manuscript.from_dirs(*directories)
+    path = str(tmp_path / "cache" / "manuscript.pickle")
+    key = manuscript.cache_key(directories)
+
+    ms.unpicklable = lambda: None # a failed dump leaves neither a cache nor a temporary file behind
+    with pytest.raises(Exception):
+        manuscript.write_cache(path, key, ms)
+    assert os.listdir(tmp_path / "cache") == []
+    del ms.unpicklable
+
+    with ThreadPoolExecutor(max_workers=4) as executor: # sessions cold-loading the same cache at once
+        list(executor.map(lambda _: manuscript.write_cache(path, key, ms), range(4)))
+    assert os.listdir(tmp_path / "cache") == ["manuscript.pickle"]
+    assert texts(manuscript.read_cache(path, key)) == texts(ms)
+
+def test_text_store_save_is_atomic(tmp_path):
+    path = str(tmp_path / "stores" / "entries_tl_text.bin")
+    stores = [TextStore.from_texts([("1r1", f"texte {i}" * (i + 1))]) for i in range(4)]
+    with ThreadPoolExecutor(max_workers=4) as executor: # processes building the same store at once
+        list(executor.map(lambda store: store.save(path), stores))
+    assert os.listdir(tmp_path / "stores") == ["entries_tl_text.bin"]
+    assert TextStore.load(path)["1r1"] in [store["1r1"] for store in stores]
+
+    broken = TextStore.from_texts([("1r1", "texte")])
+    broken.buffer = None # fails while writing the text
+    with pytest.raises(TypeError):
+        broken.save(path)
+    assert os.listdir(tmp_path / "stores") == ["entries_tl_text.bin"]
+
+def test_search_of_unknown_version_raises(tmp_path):
+    ms = Manuscript.from_dirs(*synthetic.generate(str(tmp_path / "ms-xml"), scale=0.05))
+    for call in (lambda: ms.search("sable", versions="tk"), lambda: ms.concordance("sable", version="tk")):
+        with pytest.raises(KeyError):
+            call()
+    assert "tk" not in ms.indexes
+
+def small_manuscript() -> Manuscript:
+    """A manuscript of a few hand-written entries, for checks which need to know exactly what each entry contains."""
+    divs = {
+        "1r1": ('medicine', '<ab>Eau, <m>eau</m> et <m>eau</m>. <pa>Rose</pa></ab>'),
+        "1r2": ('metal processing', '<head>Eau de vie</head>\n<ab>Prenez de l\'eau de vie et du <m>sable</m> de fonderie, puis laissez reposer longtemps au soleil</ab>'),
+        "1v1": ('metal processing', '<ab>Pour fondre le <m>fer</m>, mettez-le dans le <m>sable</m></ab>'),
+        "1v2": ('', '<ab>Une fois fondu, versez l\'eau de vie sur la <pa>rose</pa> et la <pa>rose</pa> séchée</ab>'),
+    }
+    entries = [entry.Entry.from_string(f'<entry><div id="p{identity[:-1].zfill(3)}_{identity[-1]}" categories="{categories}">{body}</div></entry>', identity=identity, folio=identity[:-1])
+               for identity, (categories, body) in divs.items()]
+    return Manuscript(entries={"tl": entries})
+
+def test_search_ranks_by_bm25():
+    ms = small_manuscript()
+    results = ms.search("eau")
+    assert [r.identity for r in results] == ["1r1", "1r2", "1v2"] # by number of occurrences: 3, 2 and 1
+    assert results[0].score > results[1].score > results[2].score > 0
+    assert all(r.version == "tl" and r.folio == r.identity[:-1] for r in results)
+
+    index = ms.text_index("tl")
+    counts = index.lookup("term", ["eau"])
+    assert counts == {"1r1": 3, "1r2": 2, "1v2": 1}
+    # BM25 with the index's parameters, e.g. for the top result
+    idf = math.log(1 + (len(index) - len(counts) + 0.5) / (len(counts) + 0.5))
+    ratio = index.lengths["1r1"] / index.average_length
+    assert results[0].score == pytest.approx(idf * 3 * (index.k1 + 1) / (3 + index.k1 * (1 - index.b + index.b * ratio)))
+    assert ms.search("EAU") == ms.search("éau") == results # case and accents are ignored
+
+    # A shorter entry outranks a longer one with as many occurrences.
+    assert [r.identity for r in ms.search("sable")] == ["1v1", "1r2"]
+    assert index.lengths["1v1"] < index.lengths["1r2"]
+
+def test_search_prefixes_and_phrases():
+    ms = small_manuscript()
+    assert {r.identity for r in ms.search("fond*")} == {"1r2", "1v1", "1v2"}
+    assert {r.identity for r in ms.search('"eau de vie"')} == {"1r2", "1v2"}
+    assert {r.identity for r in ms.search("l'eau")} == {"1r2", "1v2"} # punctuation within a term makes it a phrase
+    assert {r.identity for r in ms.search('"vie eau"')} == set()
+    assert [r.identity for r in ms.search('sable fond*')] == ["1v1", "1r2"] # every clause must match
+    assert ms.text_index("tl").lookup("phrase", ["eau", "de", "vie"]) == {"1r2": 2, "1v2": 1}
+    assert ms.search("") == ms.search("absent") == []
+
+def test_search_filters():
+    ms = small_manuscript()
+    assert [r.identity for r in ms.search("eau", categories="medicine")] == ["1r1"]
+    assert [r.identity for r in ms.search("eau", categories=["medicine", "metal processing"])] == ["1r1", "1r2"]
+    assert ms.search("eau", categories="music") == []
+    assert ms.search("eau", limit=2) == ms.search("eau")[:2]
+    assert ms.search("eau", limit=0) == []
+    assert ms.search("eau", versions=["tl"]) == ms.search("eau", versions="tl") == ms.search("eau")
+
+def test_property_index_lookups():
+    ms = small_manuscript()
+    assert ms.find_entries("plant", "rose") == {"1v2": 2}
+    assert ms.find_entries("plant", "Rose") == {"1r1": 1} # terms are kept verbatim
+    assert list(ms.find_entries("material", "sable")) == ["1r2", "1v1"] # in entry order
+    assert ms.find_entries("material", "absent") == {} and ms.find_entries("plant", "rose", version="tc") == {}
+    assert ms.property_index.terms("material", "tl") == {"eau": {"1r1": 2}, "sable": {"1r2": 1, "1v1": 1}, "fer": {"1v1": 1}}
+    assert ms.property_index.entry_terms("tl", "1v2")["plant"] == {"rose": 2}
+    assert ms.property_index.entry_terms("tl", "9r9") == {}
+
+    # The index is rebuilt when entries change.
+    ms.add_entry("tl", entry.Entry.from_string('<entry><div id="p002r_1"><pa>rose</pa></div></entry>', identity="2r1", folio="2r"))
+    assert ms.find_entries("plant", "rose") == {"1v2": 2, "2r1": 1}
+
+def test_iter_entries_matches_generate_entries(tmp_path):
+    directories = synthetic.generate(str(tmp_path / "ms-xml"), scale=0.1)
+    for directory in directories:
+        generated = manuscript.generate_entries(directory)
+        streamed = sorted(manuscript.iter_entries(directory), key=lambda e: e.identity)
+        assert len(manuscript.list_files(directory)) > 1
+        assert any(len(e.xml.findall("div")) > 1 for e in generated) # some entries are continued on the next folio
+        assert [(e.identity, e.folio, e.xml_string, e.text) for e in streamed] == [(e.identity, e.folio, e.xml_string, e.text) for e in generated]
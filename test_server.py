@@ -0,0 +1,104 @@
+"""Smoke test of server.py on a small synthetic manuscript, served on a free port. Run with `python -m pytest`."""
+import json
+import asyncio
+import threading
+import http.client
+
+import pytest
+
+import entry
+import synthetic
+from manuscript import Manuscript, display_id
+from server import ManuscriptServer
+
+@pytest.fixture(scope="module")
+def ms(tmp_path_factory):
+    return Manuscript.from_dirs(*synthetic.generate(str(tmp_path_factory.mktemp("ms-xml")), scale=0.05))
+
+@pytest.fixture(scope="module")
+def port(ms):
+    loop = asyncio.new_event_loop()
+    manuscript_server = ManuscriptServer(ms)
+    server = loop.run_until_complete(manuscript_server.start(port=0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server.sockets[0].getsockname()[1]
+
+    async def stop():
+        server.close()
+        await server.wait_closed()
+        await asyncio.gather(*(task for task in asyncio.all_tasks() if task is not asyncio.current_task())) # connections still open
+    asyncio.run_coroutine_threadsafe(stop(), loop).result(timeout=10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    manuscript_server.executor.shutdown()
+
+@pytest.fixture
+def fetch(port):
+    """Send requests on one connection, kept alive between them, and return the status, headers and body of each response."""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    def send(path, method="GET", headers={}):
+        connection.request(method, path, headers=headers)
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    yield send
+    connection.close()
+
+def test_routes(ms, fetch):
+    identity = next(iter(ms.entries["tl"]))
+    e = ms.entries["tl"][identity]
+
+    status, headers, body = fetch("/versions")
+    assert status == 200 and headers["Content-Type"].startswith("application/json")
+    assert json.loads(body) == {version: {"entries": len(ms.entries[version]), "folios": len(ms.folios[version])} for version in ms.versions}
+
+    assert len(json.loads(fetch("/entries/tl")[2])) == len(ms.entries["tl"])
+    for path in (f"/entries/tl/{identity}", f"/entries/tl/{display_id(identity)}"):
+        status, _, body = fetch(path)
+        assert status == 200 and json.loads(body)["text"] == e.text and json.loads(body)["xml"] == e.xml_string
+    status, headers, body = fetch(f"/entries/tl/{identity}/text")
+    assert headers["Content-Type"].startswith("text/plain") and body.decode("utf-8") == e.text
+    assert json.loads(fetch(f"/entries/tl/{identity}/properties")[2]) == e.properties
+
+    assert json.loads(fetch("/folios/tl")[2]) == list(ms.folios["tl"])
+    assert json.loads(fetch("/folios/tl/001r")[2]) == json.loads(fetch("/folios/tl/1r")[2])
+    assert fetch("/folios/tl/1r/text")[2].decode("utf-8") == ms.folios["tl"]["1r"].text
+
+    assert json.loads(fetch(f"/metadata/{identity}")[2])["div_id"] == display_id(identity)
+    results = json.loads(fetch("/search?q=sable&version=tl&limit=2")[2])
+    assert 0 < len(results) <= 2 and all(result["version"] == "tl" for result in results)
+
+def test_errors(ms, fetch):
+    for path in ("/nope", "/entries/xx", "/entries/tl/p999r_9", "/folios/tl/999r", "/metadata/p999r_9"):
+        status, _, body = fetch(path)
+        assert status == 404 and "error" in json.loads(body)
+    for path in ("/search?q=sable&version=tk", "/search?q=sable&version=tl&version=tk"):
+        status, _, body = fetch(path)
+        assert status == 404 and "tk" in json.loads(body)["error"]
+    for path in ("/search", "/search?q=sable&limit=x"):
+        assert fetch(path)[0] == 400
+
+    assert set(ms.indexes) <= set(ms.versions)
+
+    status, headers, _ = fetch("/versions", method="POST")
+    assert status == 405 and headers["Allow"] == "GET, HEAD"
+
+def test_etag_and_head(fetch):
+    status, headers, body = fetch("/folios/tl")
+    status, revalidated, not_modified = fetch("/folios/tl", headers={"If-None-Match": headers["ETag"]})
+    assert status == 304 and revalidated["ETag"] == headers["ETag"] and not_modified == b""
+    assert fetch("/folios/tl", headers={"If-None-Match": '"stale"'})[0] == 200
+
+    status, head_headers, head_body = fetch("/folios/tl", method="HEAD")
+    assert status == 200 and head_body == b"" and int(head_headers["Content-Length"]) == len(body)
+
+def test_metadata_of_entry_missing_from_a_version(ms, fetch):
+    ms.add_entry("tl", entry.Entry.from_string('<entry><div id="p005r_9"><head>nouveau</head><ab>sable</ab></div></entry>', folio="5r", identity="5r9"))
+    try:
+        status, _, body = fetch("/metadata/p005r_9")
+        row = json.loads(body)
+        assert status == 200 and row == ms.generate_metadata(identities=["5r9"]).iloc[0].to_dict()
+        assert row["heading_tl"] == "nouveau" and row["heading_tc"] == row["heading_tcn"] == ""
+    finally:
+        del ms.entries["tl"]["5r9"]
@@ -0,0 +1,93 @@
+"""Tests of thesaurus.py on a small synthetic manuscript, with spaCy replaced by a stub, so they run without the English model. Run with `python -m pytest`."""
+import sys
+import importlib
+from types import SimpleNamespace, ModuleType
+
+import pytest
+import pandas as pd
+
+pytest.importorskip("inflection")
+pytest.importorskip("tqdm")
+
+import synthetic
+from manuscript import Manuscript, display_id
+
+class StubNLP():
+    """Stand-in for a spaCy pipeline: each word is a noun, and the last word of a text is its head. Records every text parsed."""
+    def __init__(self):
+        self.parsed = []
+
+    def parse(self, text: str):
+        tokens = [SimpleNamespace(text=word, pos_="NOUN") for word in text.split()] or [SimpleNamespace(text="", pos_="X")]
+        for token in tokens:
+            token.head = tokens[-1]
+        return tokens
+
+    def pipe(self, texts, disable=(), n_process=1):
+        for text in texts:
+            self.parsed.append(text)
+            yield self.parse(text)
+
+    def __call__(self, text: str):
+        return next(self.pipe([text]))
+
+@pytest.fixture
+def thesaurus(monkeypatch):
+    nlp = StubNLP()
+    spacy = ModuleType("spacy")
+    spacy.load = lambda name: nlp
+    spacy.tokens = SimpleNamespace(Doc=list)
+    monkeypatch.setitem(sys.modules, "spacy", spacy)
+    monkeypatch.delitem(sys.modules, "thesaurus", raising=False)
+    module = importlib.import_module("thesaurus")
+    yield module
+    sys.modules.pop("thesaurus", None) # imported with the stub, so not to be reused
+
+@pytest.fixture(scope="module")
+def ms(tmp_path_factory):
+    return Manuscript.from_dirs(*synthetic.generate(str(tmp_path_factory.mktemp("ms-xml")), scale=0.1))
+
+def nested_loop_dfs(ms: Manuscript, prop: str):
+    """The frequency frames of one property as get_prop_dfs() built them before it counted every property in one pass: a dictionary per kind of term, then one .loc row at a time."""
+    simple_properties, complex_properties = {}, {}
+    simple_df = pd.DataFrame(columns=['freq', 'verbatim_term'])
+    complex_df = pd.DataFrame(columns=['freq', 'verbatim_term'])
+    for identity, entry in sorted(ms.entries['tl'].items(), key=lambda item: display_id(item[0])):
+        for term in entry.properties[prop]:
+            if term.count(' ') == 0:
+                if term in simple_properties.keys():
+                    simple_properties[term] += 1
+                else:
+                    simple_properties[term] = 1
+            else:
+                if term in complex_properties.keys():
+                    complex_properties[term] += 1
+                else:
+                    complex_properties[term] = 1
+    for i, term in enumerate(simple_properties.keys()):
+        simple_df.loc[i] = [simple_properties[term], term]
+    for i, term in enumerate(complex_properties.keys()):
+        complex_df.loc[i] = [complex_properties[term], term]
+    return simple_df, complex_df
+
+def test_prop_dfs_match_nested_loops(thesaurus, ms):
+    dfs = thesaurus.get_prop_dfs(ms)
+    assert list(dfs) == thesaurus.properties
+    assert any(len(df) for prop_dfs in dfs.values() for df in prop_dfs) # the synthetic manuscript has terms to count
+    for prop in thesaurus.properties:
+        for df, expected in zip(dfs[prop], nested_loop_dfs(ms, prop)):
+            assert list(df.columns) == ['freq', 'verbatim_term']
+            assert df.to_csv(index=False) == expected.to_csv(index=False), prop
+
+def test_terms_parsed_once_in_batches(thesaurus, ms):
+    dfs = thesaurus.get_prop_dfs(ms)
+    thesaurus.parse_terms(dfs)
+    nlp = thesaurus.nlp
+    assert nlp.parsed and len(nlp.parsed) == len(set(nlp.parsed))
+
+    parsed = len(nlp.parsed)
+    for simple_df, complex_df in dfs.values(): # normalizing every term now only reads the memo
+        simple_df['prefLabel_en'] = simple_df.verbatim_term.apply(lambda x: thesaurus.singularize(thesaurus.strip_simple(x)))
+        complex_df['prefLabel_en'] = complex_df.verbatim_term.apply(lambda x: x.replace('\'', '').lower().strip())
+        thesaurus.simplify_terms(simple_df, complex_df)
+    assert len(nlp.parsed) == parsed
@@ -0,0 +1,192 @@
+"""Tests of update.py on a small synthetic manuscript, made with synthetic.py. Run with `python -m pytest`."""
+import os
+import re
+import time
+import csv
+import shutil
+import filecmp
+import argparse
+
+import pytest
+
+import synthetic
+import update
+import writer
+import manuscript
+from watch import Watcher
+from manifest import Manifest
+from manuscript import Manuscript
+
+def add_div(directory: str, folio: str, div: str) -> str:
+    """Append a div to a synthetic folio file, as an editor would, and return the path of the file."""
+    version = os.path.basename(directory)
+    filepath = os.path.join(directory, f"{version}_p{folio}_preTEI.xml")
+    with open(filepath, encoding="utf-8") as fp:
+        xml = fp.read()
+    with open(filepath, "w", encoding="utf-8") as fp:
+        fp.write(xml.replace("</folio>", div + "\n</folio>"))
+    return filepath
+
+def read_rows(path: str):
+    with open(path, encoding="utf-8", newline="") as fp:
+        return {row["div_id"]: row for row in csv.DictReader(fp)}
+
+def edit(directories):
+    """Make the kinds of changes editors make in each version: change the continuation of an entry, delete a folio, rename an entry, and add a folio."""
+    for directory in directories:
+        filepaths = manuscript.list_files(directory)
+        sources = {}
+        for filepath in filepaths:
+            with open(filepath, encoding="utf-8") as fp:
+                sources[filepath] = fp.read()
+        filepath = next(filepath for filepath, xml in sources.items() if 'continued="yes"' in xml)
+        with open(filepath, "w", encoding="utf-8") as fp:
+            fp.write(sources[filepath].replace('continued="yes">\n<ab>', 'continued="yes">\n<ab>eau ', 1))
+        os.remove(filepaths[3])
+        with open(filepaths[6], "w", encoding="utf-8") as fp:
+            fp.write(re.sub(r'id="p(\d+[rv])_(\d)"', r'id="p\1_\g<2>9"', sources[filepaths[6]], count=1))
+        version = os.path.basename(directory)
+        shutil.copy(filepaths[-1], os.path.join(directory, f"{version}_p999r_preTEI.xml"))
+        add_div(directory, "999r", '<div id="p999r_1"><head>nouveau</head><ab>sable</ab></div>')
+
+def same_files(left: str, right: str) -> bool:
+    """Return whether two derivative folders hold the same files with the same content, besides their manifests."""
+    comparison = filecmp.dircmp(left, right, ignore=[Manifest.filename])
+    if comparison.left_only or comparison.right_only or filecmp.cmpfiles(left, right, comparison.common_files, shallow=False)[1:] != ([], []):
+        return False
+    return all(same_files(os.path.join(left, name), os.path.join(right, name)) for name in comparison.common_dirs)
+
+def derivative_args(outdir: str) -> argparse.Namespace:
+    """Return the arguments with which update.py writes every derivative to a subfolder of `outdir`."""
+    return argparse.Namespace(**{flag: os.path.join(outdir, flag) for flag in ("metadata", "entries", "txt", "all_folios")}, dry_run=False, write_jobs=1)
+
+def full_update(directories, outdir: str) -> argparse.Namespace:
+    args = derivative_args(outdir)
+    update.write_derivatives(Manuscript.from_dirs(*directories), args, announce=False)
+    return args
+
+@pytest.fixture
+def corpus(tmp_path):
+    directories = synthetic.generate(str(tmp_path / "ms-xml"), scale=0.05)
+    ms = Manuscript.from_dirs(*directories)
+    args = derivative_args(str(tmp_path))
+    update.write_derivatives(ms, args, announce=False)
+    return directories, ms, args
+
+def test_watch_entry_added_to_tl_only(corpus):
+    directories, ms, args = corpus
+    tl = directories[-1]
+    filepath = add_div(tl, "005r", '<div id="p005r_9"><head>nouveau</head><ab>sable</ab></div>')
+
+    assert update.watch_cycle(ms, {tl: [filepath]}, args)
+    rows = read_rows(os.path.join(args.metadata, "entry_metadata.csv"))
+    assert rows["p005r_9"]["heading_tl"] == "nouveau"
+    assert rows["p005r_9"]["heading_tc"] == rows["p005r_9"]["heading_tcn"] == ""
+
+def test_watch_keeps_going_after_errors(corpus, capsys):
+    directories, ms, args = corpus
+    tl = directories[-1]
+    filepath = add_div(tl, "005r", "<div")
+    assert not update.watch_cycle(ms, {tl: [filepath]}, args)
+    assert "invalid XML" in capsys.readouterr().out
+
+    # An error writing the derivatives is reported, and the next cycle still works.
+    outdir = args.metadata
+    args.metadata = os.path.join(outdir, "entry_metadata.csv", "not a folder")
+    filepath = add_div(tl, "005v", '<div id="p005v_9"><ab>sable</ab></div>')
+    assert not update.watch_cycle(ms, {tl: [filepath]}, args)
+
+    args.metadata = outdir
+    assert update.watch_cycle(ms, {tl: [filepath]}, args)
+    assert "p005v_9" in read_rows(os.path.join(outdir, "entry_metadata.csv"))
+
+def test_incremental_rewrites_deleted_files(corpus):
+    directories, ms, args = corpus
+    deleted = [os.path.join(args.metadata, "entry_metadata.csv"), os.path.join(args.entries, "txt", "tl", "tl_p001r_1.txt"),
+               os.path.join(args.txt, "tc", "tc_p001v_preTEI.txt"), os.path.join(args.all_folios, "xml", "tcn", "all_tcn.xml")]
+    for filepath in deleted:
+        os.remove(filepath)
+    update.write_derivatives(ms, args, incremental=True, announce=False)
+    assert all(os.path.exists(filepath) for filepath in deleted)
+
+def test_run_rewrites_deleted_files(corpus, tmp_path, monkeypatch, capsys):
+    # As `update.py -b -i`, which exits early without loading the manuscript if no source changed.
+    directories, ms, args = corpus
+    monkeypatch.setattr(update, "update_time", lambda: None) # which would edit update.py
+    args = argparse.Namespace(**vars(args), path=str(tmp_path), incremental=True, watch=False, jobs=1, renderer="native")
+    update.run(args)
+    assert "Derivatives are up to date." in capsys.readouterr().out
+
+    deleted = os.path.join(args.entries, "txt", "tl", "tl_p001r_1.txt")
+    os.remove(deleted)
+    update.run(args)
+    assert "Derivatives are up to date." not in capsys.readouterr().out
+    assert os.path.exists(deleted)
+
+def test_manifest_records_sources_as_loaded(corpus):
+    directories, ms, args = corpus
+    tl = directories[-1]
+    sources = {os.path.basename(directory): manuscript.hash_dir(directory) for directory in directories}
+    add_div(tl, "005r", '<div id="p005r_9"><ab>sable</ab></div>') # changed after loading, so not in the derivatives
+    update.write_derivatives(ms, args, incremental=True, announce=False)
+    for flag in ("metadata", "entries", "txt", "all_folios"):
+        manifest = Manifest(getattr(args, flag))
+        assert manifest.up_to_date(sources)
+        assert not manifest.up_to_date({os.path.basename(directory): manuscript.hash_dir(directory) for directory in directories})
+
+def test_incremental_matches_full(corpus, tmp_path):
+    directories, ms, args = corpus
+    edit(directories)
+    update.write_derivatives(Manuscript.from_dirs(*directories), args, incremental=True, announce=False)
+    full = full_update(directories, str(tmp_path / "full"))
+    for flag in ("metadata", "entries", "txt", "all_folios"):
+        assert same_files(getattr(args, flag), getattr(full, flag)), flag
+
+def test_refresh_matches_fresh_load(corpus, tmp_path):
+    directories, ms, args = corpus
+    watcher = Watcher(directories)
+    edit(directories)
+    assert update.watch_cycle(ms, watcher.poll(), args)
+
+    fresh = Manuscript.from_dirs(*directories)
+    assert ms.versions == fresh.versions and ms.source_hashes() == fresh.source_hashes()
+    for kind in ("entries", "folios"):
+        for version in fresh.versions:
+            refreshed, loaded = getattr(ms, kind)[version], getattr(fresh, kind)[version]
+            assert list(refreshed) == list(loaded)
+            for key, e in loaded.items():
+                assert (refreshed[key].folio, refreshed[key].identity, refreshed[key].xml_string, refreshed[key].text) == (e.folio, e.identity, e.xml_string, e.text), (kind, version, key)
+
+    full = full_update(directories, str(tmp_path / "full"))
+    for flag in ("metadata", "entries", "txt", "all_folios"):
+        assert same_files(getattr(args, flag), getattr(full, flag)), flag
+
+def test_watch_ignores_editor_backups(corpus):
+    directories, ms, args = corpus
+    tl = directories[-1]
+    watcher = Watcher(directories)
+    filepath = os.path.join(tl, "tl_p005r_preTEI.xml")
+    shutil.copy(filepath, filepath + "~") # stale backup, which sorts after the file it backs up
+    with open(os.path.join(tl, ".tl_p005r_preTEI.xml.swp"), "w", encoding="utf-8") as fp:
+        fp.write("<div") # half-written swap file
+    add_div(tl, "005r", '<div id="p005r_9"><head>nouveau</head><ab>sable</ab></div>')
+
+    assert watcher.poll() == {tl: [filepath]}
+    assert update.watch_cycle(ms, {tl: [filepath]}, args)
+    assert read_rows(os.path.join(args.metadata, "entry_metadata.csv"))["p005r_9"]["heading_tl"] == "nouveau"
+    assert Manuscript.from_dirs(tl).get_entry("tl", "p005r_9").title == "nouveau"
+
+def test_update_removes_leftover_temp_files(corpus):
+    directories, ms, args = corpus
+    txt_dir = os.path.join(args.entries, "txt", "tl")
+    leftover = os.path.join(txt_dir, ".tl_p001r_1.txt.k2x9_a7q.tmp") # as left by a write interrupted by a crash
+    in_use = os.path.join(txt_dir, ".tl_p001r_2.txt.b7c0_x2m.tmp") # as being written by another update running at the same time
+    for filepath in (leftover, in_use):
+        with open(filepath, "w", encoding="utf-8") as fp:
+            fp.write("partial")
+    old = time.time() - writer.temp_max_age - 60
+    os.utime(leftover, (old, old))
+    update.write_derivatives(ms, args, incremental=True, announce=False)
+    assert not os.path.exists(leftover)
+    assert os.path.exists(in_use)
+    assert os.path.exists(os.path.join(args.entries, Manifest.filename))
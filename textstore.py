@@ -0,0 +1,100 @@
+"""Compact storage of rendered text: the texts of a collection packed into one contiguous utf-8 buffer with an offset table,
+which can be saved to a file and memory-mapped, so several processes can share one copy of the corpus text.
+"""
+from typing import List, Tuple, Iterable, Iterator
+import json
+import mmap
+import struct
+import numpy as np
+
+from writer import atomic_open
+
+magic = b"MSTEXT1\n"
+header = struct.Struct("<8sQQ") # magic, number of texts, length of the JSON list of keys
+
+class TextStore():
+    def __init__(self, keys: List[str], offsets: np.ndarray, buffer, path: str = None):
+        """Hold the text of each key in `keys`, the i-th being the utf-8 bytes of `buffer` between offsets[i] and offsets[i+1].
+        Use from_texts() to build a store, and save() and load() to write it to a file and map it back.
+        `path` is the file the store was loaded from, if any: such a store is pickled as its path, and mapped again when unpickled.
+        """
+        self.keys = keys
+        self.positions = {key: i for i, key in enumerate(keys)}
+        self.offsets = offsets
+        self.buffer = memoryview(buffer)
+        self.path = path
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[Tuple[str, str]]):
+        """Build a store in memory from (key, text) pairs."""
+        keys, parts, lengths = [], [], [0]
+        for key, text in texts:
+            data = text.encode("utf-8")
+            keys.append(key)
+            parts.append(data)
+            lengths.append(len(data))
+        return cls(keys, np.cumsum(lengths, dtype=np.int64), b"".join(parts))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys)
+
+    def span(self, key: str) -> Tuple[int, int]:
+        """Return the start and end byte offsets of a text in the buffer."""
+        i = self.positions[key]
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def view(self, key: str) -> memoryview:
+        """Return the utf-8 bytes of a text as a slice of the buffer, without copying them."""
+        start, end = self.span(key)
+        return self.buffer[start:end]
+
+    def __getitem__(self, key: str) -> str:
+        """Return a text, decoded from the buffer."""
+        return str(self.view(key), "utf-8")
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the text buffer in bytes."""
+        return self.buffer.nbytes
+
+    def save(self, path: str) -> None:
+        """Write the store to a file, replacing it atomically: a header, the keys as JSON, the offsets as little-endian 64-bit integers aligned to 8 bytes, then the text."""
+        keys = json.dumps(self.keys, ensure_ascii=False).encode("utf-8")
+        padding = -(header.size + len(keys)) % 8
+        with atomic_open(path, "wb") as fp: # a temporary file of its own, so a process mapping the store never sees another's partial write
+            fp.write(header.pack(magic, len(self.keys), len(keys)))
+            fp.write(keys + b"\0" * padding)
+            fp.write(self.offsets.astype("<i8").tobytes())
+            fp.write(self.buffer)
+
+    @classmethod
+    def load(cls, path: str, map_file: bool = True):
+        """Load a store saved with save(). By default, the file is memory-mapped read-only rather than read,
+        so its pages are shared by every process mapping it, and only read from disk when used.
+        """
+        with open(path, "rb") as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if map_file else fp.read()
+        file_magic, n, keys_length = header.unpack_from(data, 0)
+        if file_magic != magic:
+            raise Exception(f"Not a text store: '{path}'")
+        start = header.size
+        keys = json.loads(bytes(data[start:start + keys_length]).decode("utf-8"))
+        start += keys_length + (-(header.size + keys_length) % 8)
+        offsets = np.frombuffer(data, dtype="<i8", count=n + 1, offset=start)
+        start += (n + 1) * 8
+        return cls(keys, offsets, memoryview(data)[start:], path=path)
+
+    def __reduce__(self):
+        """Pickle a store loaded from a file as its path, so that other processes map the same file instead of receiving a copy of the text."""
+        if self.path:
+            return (self.load, (self.path,))
+        return (self.__class__, (self.keys, np.array(self.offsets), bytes(self.buffer)))
+
+    def __repr__(self):
+        return f"TextStore({len(self.keys)} texts, {self.nbytes} bytes{', ' + self.path if self.path else ''})"
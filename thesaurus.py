@@ -2,7 +2,9 @@
 # Python Modules
 import os
 import re
-from typing import Dict
+import argparse
+from collections import Counter
+from typing import Dict, Iterable, Tuple
 
 # Third-Party Modules
 import inflection
@@ -12,8 +14,10 @@ from tqdm import tqdm
 
 
 # Local Modules
-from digital_manuscript import BnF
+from manuscript import Manuscript, display_id
 nlp = spacy.load('en_core_web_sm')
+unused_components = ['ner', 'lemmatizer', 'textcat'] # only part-of-speech tags and the dependency parse are used
+parses: Dict[str, spacy.tokens.Doc] = {} # memo of every string parsed so far, so each is only parsed once
 
 cwd = os.getcwd()
 m_path = cwd if 'manuscript-object' not in cwd else f'{cwd}/../'
@@ -23,77 +27,104 @@ properties = ['animal', 'body_part', 'currency', 'definition', 'environment', 'm
               'medical', 'measurement', 'music', 'plant', 'place', 'personal_name',
               'profession', 'sensory', 'tool', 'time', 'weapon']
 
-def get_prop_dfs(manuscript: BnF, prop_type: str) -> (pd.DataFrame, pd.DataFrame):
+def get_prop_dfs(manuscript: Manuscript) -> Dict[str, Tuple[pd.DataFrame, pd.DataFrame]]:
   """
-  For each element of the 'properties' list, iterate through the manuscript, and pull out all properties of that type.
-  If the property is a single word, it is simple. Multiple-word properties are complex. Put each property in the
-  appropriate dictionary while counting occurrences. 
+  Iterate through the manuscript once, and pull out the terms of every property in the list 'properties'.
+  If the term is a single word, it is simple. Multiple-word terms are complex. Count the occurrences of each term in
+  the appropriate counter of its property, then build each property's DataFrames at once.
 
   Inputs:
-    manuscript: BnF -- The BnF data used to source the terms for the thesaurus.
-    prop_type: str -- one element of the list 'properties', defined globally.
+    manuscript: Manuscript -- The manuscript used to source the terms for the thesaurus.
   Output:
-    simple_df, complex_df -- a tuple of two DataFrame: one of one word terms, and one of two word terms.
+    a dict keyed by property of tuples of two DataFrames with the columns 'freq' and 'verbatim_term': one of one
+    word terms, and one of multiple word terms, each in order of first occurrence in folio order.
   """
-  simple_properties, complex_properties = {}, {} # initalize variables
-  simple_df = pd.DataFrame(columns=['freq', 'verbatim_term'])
-  complex_df = pd.DataFrame(columns=['freq', 'verbatim_term'])
-
-  for identity, entry in manuscript.entries.items():
-    prop_list = entry.get_prop(prop_type, 'tl')
-    for prop in prop_list: # bucket each property for each entry
-
-      # prop = re.sub(r"’|'", '', prop)
-
-      if prop.count(' ') == 0: # if the term is one word
-        if prop in simple_properties.keys(): # if we've seen it before,
-          simple_properties[prop] += 1 # increment the count
-        else: # if it's new, initialize the count to one
-          simple_properties[prop] = 1
-
-      else: # if the term is multiple words, following logic above
-        if prop in complex_properties.keys(): 
-          complex_properties[prop] += 1
-        else:
-          complex_properties[prop] = 1
-  
-  # format the dict into a DataFrame
-  for i, prop in enumerate(simple_properties.keys()):
-    simple_df.loc[i] = [simple_properties[prop], prop]
-  for i, prop in enumerate(complex_properties.keys()):
-    complex_df.loc[i] = [complex_properties[prop], prop]
+  counts = {prop: (Counter(), Counter()) for prop in properties} # simple and complex term counts of each property
+
+  # in folio order, as in the committed thesaurus, rather than in the order of Manuscript IDs (10r1 before 2r1)
+  for identity, entry in sorted(manuscript.entries['tl'].items(), key=lambda item: display_id(item[0])):
+    entry_properties = entry.properties
+    for prop, (simple_properties, complex_properties) in counts.items():
+      for term in entry_properties[prop]: # bucket each term for each entry
+
+        # term = re.sub(r"’|'", '', term)
+
+        if term.count(' ') == 0: # if the term is one word
+          simple_properties[term] += 1
+        else: # if the term is multiple words
+          complex_properties[term] += 1
+
+  # format the counters into DataFrames
+  return {prop: tuple(pd.DataFrame({'freq': list(counter.values()), 'verbatim_term': list(counter.keys())}, columns=['freq', 'verbatim_term'])
+                      for counter in prop_counts)
+          for prop, prop_counts in counts.items()}
+
+def parse_all(texts: Iterable[str], n_process: int = 1) -> None:
+  """
+  Parse every string not parsed yet in batches with nlp.pipe, skipping unused pipeline components, and store the
+  results in the memo used by parse().
+
+  Inputs:
+    texts: Iterable[str] -- strings to parse; duplicates and strings already parsed are skipped.
+    n_process: int -- number of processes over which to spread parsing.
+  """
+  new_texts = list(dict.fromkeys(text for text in texts if text not in parses))
+  for text, doc in zip(new_texts, nlp.pipe(new_texts, disable=unused_components, n_process=n_process)):
+    parses[text] = doc
 
-  return simple_df, complex_df
+def parse(text: str) -> spacy.tokens.Doc:
+  """ Return the parse of a string, from the memo if it has already been parsed. """
+  if text not in parses:
+    parse_all([text])
+  return parses[text]
+
+def find_head(term: str) -> str:
+  """ Return the text of the semantic head of a term. """
+  return [token for token in parse(term) if token.head.text == token.text][0].text
 
 def simplify_terms(simple_df: pd.DataFrame, complex_df:pd.DataFrame) -> pd.DataFrame:
   """
   Find the semantic head of each complex term. If the head is a simple term, the head becomes the preferred label.
   
   Inputs:
-    simple_df: BnF -- DataFrame containing one-word terms
-    complex_df: BnF -- DataFrame containing multi-word terms
+    simple_df: pd.DataFrame -- DataFrame containing one-word terms
+    complex_df: pd.DataFrame -- DataFrame containing multi-word terms
   Output:
-    complex_df: BnF -- complex_df with semantic head as preferred label.
+    complex_df: pd.DataFrame -- complex_df with semantic head as preferred label.
   """
   simple_terms = list(simple_df['prefLabel_en'])
   for i, row in complex_df.iterrows():
-    parse = nlp(row.verbatim_term)
-
-    head = [token for token in parse if token.head.text == token.text][0].text
-    head = nlp(head)[0]
+    head = parse(find_head(row.verbatim_term))[0]
     head = inflection.singularize(head.text) if head.pos_ in ['NOUN', 'PROPN'] else head.text
     if head in simple_terms:
       complex_df.loc[i, 'prefLabel_en'] = head
   return complex_df
 
+def strip_simple(term: str) -> str:
+  """ Remove apostrophes from a one-word term before singularizing it. """
+  return re.sub(r"’|'", '', term)
+
 def singularize(term: str) -> str:
   if not term:
     return term
-  parse = nlp(term.lower().strip())[0]
-  return inflection.singularize(term) if parse.pos_ in ['NOUN', 'PROPN'] else term
+  token = parse(term.lower().strip())[0]
+  return inflection.singularize(term) if token.pos_ in ['NOUN', 'PROPN'] else term
+
+def parse_terms(dfs: Dict[str, tuple], n_process: int = 1) -> None:
+  """
+  Parse every string the normalization of the given terms needs, for all properties at once, in two batches:
+  first the simple terms and the complex terms, then the semantic heads of the complex terms.
 
+  Inputs:
+    dfs: Dict[str, tuple] -- (simple_df, complex_df) tuples as returned by get_prop_dfs(), keyed by property.
+    n_process: int -- number of processes over which to spread parsing.
+  """
+  simple_texts = [strip_simple(term).lower().strip() for simple_df, _ in dfs.values() for term in simple_df.verbatim_term]
+  complex_texts = [term for _, complex_df in dfs.values() for term in complex_df.verbatim_term]
+  parse_all([text for text in simple_texts if text] + complex_texts, n_process=n_process)
+  parse_all([find_head(term) for term in complex_texts], n_process=n_process)
 
-def create_thesaurus():
+def create_thesaurus(n_process: int = 1):
   """ 
   Creates directory 'thesaurus' containing a .csv file for each property. Each .csv has three columns, count,
   verbatim_term, and prefLabel_en. Count is the number of occurrences of the verbatim term in the manuscript.
@@ -105,18 +136,23 @@ def create_thesaurus():
   3. Singularize all terms
   4. If the term consists of multiple words, find its semantic head. If the head is also a term of the same property,
   the preferred label becomes the semantic head.
+
+  Every distinct string is parsed once, in batches, spread over `n_process` processes.
   """
-  manuscript = BnF(apply_corrections=False)
+  manuscript = Manuscript.load_cached()
 
   # Create directory 'thesaurus' if one does not exist
   if not os.path.exists(m_k_data_to_thesaurus):
     os.mkdir(m_k_data_to_thesaurus)
 
+  dfs = get_prop_dfs(manuscript) # get dataframes of count, verbatim terms
+  parse_terms(dfs, n_process=n_process)
+
   for prop in tqdm(properties):
-    simple_df, complex_df = get_prop_dfs(manuscript, prop) # get dataframe of count, verbatim terms
+    simple_df, complex_df = dfs[prop]
 
     # create the prefLabel_en column by lemmatizing terms to lower case, singular, and stripped of white space
-    simple_df['prefLabel_en'] = simple_df.verbatim_term.apply(lambda x: singularize(re.sub(r"’|'", '', x)))
+    simple_df['prefLabel_en'] = simple_df.verbatim_term.apply(lambda x: singularize(strip_simple(x)))
     complex_df['prefLabel_en'] = complex_df.verbatim_term.apply(lambda x: x.replace('\'', '').lower().strip())
 
     complex_df = simplify_terms(simple_df, complex_df) # reduce complex terms to their semantic heads
@@ -124,5 +160,9 @@ def create_thesaurus():
 
     df = pd.concat([simple_df, complex_df]) # merge dataframes 
     df.to_csv(f'{m_k_data_to_thesaurus}/{prop}.csv', index=False) # write dataframe to a file
-    
-create_thesaurus()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Generate the thesaurus of each property's terms, with their preferred labels.")
+  parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of processes used to parse terms. Defaults to 1.")
+  args = parser.parse_args()
+  create_thesaurus(n_process=args.jobs)
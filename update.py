@@ -4,14 +4,23 @@ import os
 import sys
 from typing import List, Dict
 import json
+import time
+import logging
 import argparse
 
 # Third Party Modules
+from lxml import etree as et
 from datetime import datetime
 
 # Local Modules
 import manuscript
+import entry
 import utils
+from manifest import Manifest
+from watch import Watcher, poll_interval
+from instrument import profiler
+
+logger = logging.getLogger(__name__)
 
 def update_time():
     """ Extract timestamp at the top of this file and update it. """
@@ -35,12 +44,19 @@ def update():
     """
     parser = argparse.ArgumentParser(description="Generate and update derivative files from original ms-xml folios.")
     parser.add_argument('-d', '--dry-run', help="Generate as usual, but do not write derivatives.", action="store_true")
-    parser.add_argument('-v', '--verbose', help="Write verbose generation progress to stdout.", action="store_true")
+    parser.add_argument('-v', '--verbose', help="Write generation progress to stdout. Repeat (-vv) to also list every file parsed and written.", action="count", default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of worker processes used to load the manuscript. Use 0 for one per CPU. Defaults to 1 (no worker processes).")
+    parser.add_argument('-r', '--renderer', choices=("native", "xslt"), default=entry.renderer, help="Backend used to render text derivatives: 'native' walks the XML tree directly, 'xslt' applies annotations.xslt. Both give the same output. Defaults to 'native'.")
+    parser.add_argument('-w', '--write-jobs', type=int, default=1, help="Number of threads used to write entries and ms-txt files. Useful on slow or network disks. Defaults to 1.")
+    parser.add_argument('-i', '--incremental', help="Only rewrite the derivatives affected by changes since the last update, as recorded in the manifest kept in each derivative folder.", action="store_true")
+    parser.add_argument('-p', '--profile', nargs="?", default=None, const="update_profile.json", help="Time each stage of the update, per version, and count files parsed, renders and bytes written. Optional argument: JSON file to which to write the report. Defaults to update_profile.json. With -j, work done in worker processes is timed but not counted.")
+    parser.add_argument('-W', '--watch', help="After updating, keep the manuscript in memory and watch the ms-xml folders, regenerating the derivatives affected by each change to a folio until interrupted with Ctrl+C.", action="store_true")
     parser.add_argument('-b', '--bypass', help="Bypass user y/n confirmation. Useful for automation.", action="store_true")
     parser.add_argument('-a', '--all-folios', nargs="?", default=argparse.SUPPRESS, const=utils.all_folios_path, help="Update allFolios derivative files. Disables generation of other derivatives unless those are also specified. Optional argument: folder path to which to write derivative files.")
     parser.add_argument('-m', '--metadata', nargs="?", default=argparse.SUPPRESS, const=utils.metadata_path, help="Update metadata derivative files. Disables generation of other derivatives unless those are also specified. Optional argument: folder path to which to write derivative files.")
     parser.add_argument('-t', '--txt', nargs="?", default=argparse.SUPPRESS, const=utils.ms_txt_path, help="Update ms-txt derivative files. Disables generation of other derivatives unless those are also specified. Optional argument: folder path to which to write derivative files.")
     parser.add_argument('-e', '--entries', nargs="?", default=argparse.SUPPRESS, const=utils.entries_path, help="Update entries derivative files. Disables generation of other derivatives unless those are also specified. Optional argument: folder path to which to write derivative files.")
+    parser.add_argument('-c', '--check-properties', nargs="?", default=argparse.SUPPRESS, const=None, help="Compare the number of terms of each property in each entry across versions, and print a summary of mismatches. Disables generation of derivatives unless those are also specified. Optional argument: CSV file to which to write the list of mismatches.")
     parser.add_argument("path", nargs="?", default=utils.manuscript_data_path, help="Path to m-k-manuscript-data directory. Defaults to the sibling of your current directory.")
 
     args = parser.parse_args()
@@ -54,41 +70,125 @@ def update():
         if not okay:
             return
 
-    if not args.verbose:
-        sys.stdout = open(os.devnull, "w") # Turn off print statements by sending them to /dev/null. Is this a bad idea? I need a UNIX expert.
-
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=(logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)])
+    profiler.reset()
+    try:
+        run(args)
+    finally:
+        if args.profile:
+            profiler.write(args.profile, arguments=sys.argv[1:], render_cache=entry.render_cache.info())
+            print(f'Profile written to {args.profile}')
+
+def run(args):
+    """Carry out the update requested by the parsed command line arguments `args`."""
     # If no specific derivatives were specified, generate all of them.
-    if not any(flag in args for flag in ('all_folios', 'entries', 'txt', 'metadata')):
+    if not any(flag in args for flag in ('all_folios', 'entries', 'txt', 'metadata', 'check_properties')):
         args.all_folios = utils.all_folios_path
         args.entries = utils.entries_path
         args.txt = utils.ms_txt_path
         args.metadata = utils.metadata_path
 
+    entry.renderer = args.renderer
+
     dirs = [os.path.join(args.path, "ms-xml", v) for v in utils.versions]
-    ms = manuscript.Manuscript.from_dirs(*dirs)
 
+    watcher = Watcher(dirs) if args.watch else None # before loading, so no change made while loading is missed
+
+    if args.incremental and 'check_properties' not in args and not args.watch:
+        # If no source file changed since the last update of each requested derivative, there is no need to even load the manuscript.
+        sources = {os.path.basename(directory): manuscript.hash_dir(directory) for directory in dirs}
+        outdirs = [getattr(args, flag) for flag in ('metadata', 'entries', 'txt', 'all_folios') if flag in args]
+        if all(Manifest(outdir).up_to_date(sources) for outdir in outdirs):
+            print('Derivatives are up to date.')
+            update_time()
+            return
+
+    ms = manuscript.Manuscript.from_dirs(*dirs, workers=args.jobs if args.jobs != 0 else os.cpu_count())
+
+    if 'check_properties' in args:
+        report = ms.check_property_counts()
+        print(f'Property counts: {len(report)} mismatched across versions {",".join(ms.versions)} in {len(ms.entries["tl"])} entries.')
+        for spread, n in manuscript.spread_buckets(report.spread).items():
+            print(f'  off by {spread}: {n}')
+        if args.check_properties:
+            report.to_csv(args.check_properties, index=False)
+            print(f'  list of mismatches written to {args.check_properties}')
+
+    write_derivatives(ms, args, incremental=args.incremental)
+    update_time()
+
+    if watcher:
+        watch(ms, watcher, args)
+
+def write_derivatives(ms, args, incremental=False, announce=True):
+    """Write the derivatives requested by the command line arguments `args`, printing a summary of each. If `announce`, also print a line before starting each one."""
     # Write only the derivatives specified.
     if 'metadata' in args:
-        if not args.dry_run:
-            print('Updating metadata..', file=sys.__stdout__)
-        ms.update_metadata(outdir=args.metadata, dry_run=args.dry_run)
+        if announce and not args.dry_run:
+            print('Updating metadata..')
+        writer = ms.update_metadata(outdir=args.metadata, dry_run=args.dry_run, incremental=incremental)
+        print(f'  metadata: {writer.summary()}')
 
     if 'entries' in args:
-        if not args.dry_run:
-            print('Updating entries...', file=sys.__stdout__)
-        ms.update_entries(outdir=args.entries, dry_run=args.dry_run)
+        if announce and not args.dry_run:
+            print('Updating entries...')
+        writer = ms.update_entries(outdir=args.entries, dry_run=args.dry_run, incremental=incremental, write_workers=args.write_jobs)
+        print(f'  entries: {writer.summary()}')
 
     if 'txt' in args:
-        if not args.dry_run:
-            print('Updating ms-txt...', file=sys.__stdout__)
-        ms.update_ms_txt(outdir=args.txt, dry_run=args.dry_run)
+        if announce and not args.dry_run:
+            print('Updating ms-txt...')
+        writer = ms.update_ms_txt(outdir=args.txt, dry_run=args.dry_run, incremental=incremental, write_workers=args.write_jobs)
+        print(f'  ms-txt: {writer.summary()}')
 
     if 'all_folios' in args:
-        if not args.dry_run:
-            print('Updating allFolios...', file=sys.__stdout__)
-        ms.update_all_folios(outdir=args.all_folios, dry_run=args.dry_run)
-
-    update_time()
+        if announce and not args.dry_run:
+            print('Updating allFolios...')
+        writer = ms.update_all_folios(outdir=args.all_folios, dry_run=args.dry_run, incremental=incremental)
+        print(f'  allFolios: {writer.summary()}')
+
+def watch(ms, watcher, args):
+    """Regenerate the derivatives affected by each change to the source files found by `watcher`, until interrupted.
+    Only the changed folios are parsed again, with the entries which have divs in them, and derivatives are updated incrementally.
+    """
+    print(f'Watching {", ".join(watcher.directories)} for changes. Press Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(poll_interval)
+            changes = watcher.poll()
+            if changes:
+                watch_cycle(ms, changes, args)
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+
+def watch_cycle(ms, changes: Dict[str, List[str]], args) -> bool:
+    """Reload the changed files, keyed by version folder, and update the derivatives requested by `args`.
+    Errors are reported rather than raised, since the sources may be in an intermediate state while editors work, e.g. a new entry saved in one version before the others.
+    The files are read again when they are next saved. Returns whether the derivatives were updated.
+    """
+    start = time.perf_counter()
+    refreshed = False
+    for directory, filepaths in changes.items():
+        version = os.path.basename(directory)
+        try:
+            identities = ms.refresh(version, filepaths)
+        except et.XMLSyntaxError as error: # e.g. a file saved half-way
+            print(f'{version}: skipped, invalid XML: {error}')
+            continue
+        except Exception:
+            logger.exception("%s: skipped, failed to reload %s", version, ", ".join(os.path.basename(filepath) for filepath in filepaths))
+            continue
+        refreshed = True
+        print(f'{version}: {len(filepaths)} file{"" if len(filepaths)==1 else "s"} changed ({", ".join(os.path.basename(filepath) for filepath in filepaths)}), entries touched: {", ".join(manuscript.display_id(identity) for identity in identities) or "none"}')
+    if not refreshed:
+        return False
+    try:
+        write_derivatives(ms, args, incremental=True, announce=False)
+    except Exception:
+        logger.exception("Failed to update derivatives")
+        return False
+    print(f'Updated in {time.perf_counter() - start:.2f}s.')
+    return True
 
 if __name__ == "__main__":
     update()
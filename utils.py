@@ -11,6 +11,10 @@ entries_path = os.path.join(manuscript_data_path,"entries")
 all_folios_path = os.path.join(manuscript_data_path, "allFolios")
 metadata_path = os.path.join(manuscript_data_path, "metadata")
 
+def ignore_data_path(filepath: str) -> str:
+    """Remove the manuscript data path portion from a filepath."""
+    return filepath.partition(os.path.commonpath([os.path.abspath(filepath), manuscript_data_path]))[2]
+
 prop_dict = {
     'animal': 'al',
     'body_part': 'bp',
@@ -68,3 +72,4 @@ categories = [
 ]
 
 stylesheet_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "annotations.xslt")
+cache_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), ".cache", "manuscript.pickle") # default location of Manuscript.load_cached()
@@ -0,0 +1,45 @@
+"""Poll the ms-xml version folders for changed files, so that update.py --watch can regenerate the affected derivatives as soon as a folio is saved."""
+from typing import List, Dict, Tuple
+import os
+
+from manuscript import list_files
+from manifest import hash_file
+
+poll_interval = 0.5 # seconds between polls, so that changes are picked up within a second of saving
+
+class Watcher():
+    def __init__(self, directories: List[str]):
+        """Keep track of the files in each of the given folders, so that poll() can tell which were changed, added or deleted since the last call.
+        Folders are polled rather than watched with inotify, which keeps this portable and needs no dependencies: a poll only reads file metadata,
+        and only hashes files whose modification time or size changed, so that saving a file without changing it is not reported.
+        """
+        self.directories = directories
+        self.state: Dict[str, Dict[str, Tuple[int, int, str]]] = {directory: self.scan(directory, {}) for directory in directories}
+
+    @staticmethod
+    def scan(directory: str, previous: Dict[str, Tuple[int, int, str]]) -> Dict[str, Tuple[int, int, str]]:
+        """Return the modification time, size and hash of each folio file in a folder (see manuscript.list_files()), keyed by path. Hashes are reused from `previous` for files whose time and size did not change."""
+        state = {}
+        for filepath in list_files(directory):
+            try:
+                stat = os.stat(filepath)
+                old = previous.get(filepath)
+                if old and old[:2] == (stat.st_mtime_ns, stat.st_size):
+                    state[filepath] = old
+                else:
+                    state[filepath] = (stat.st_mtime_ns, stat.st_size, hash_file(filepath))
+            except OSError: # deleted while scanning
+                continue
+        return state
+
+    def poll(self) -> Dict[str, List[str]]:
+        """Return the paths of the files changed, added or deleted in each folder since the last poll, keyed by folder. Folders without changes are left out."""
+        changes = {}
+        for directory in self.directories:
+            previous = self.state[directory]
+            current = self.scan(directory, previous)
+            changed = sorted(filepath for filepath in previous.keys() | current.keys() if (previous.get(filepath) or (0, 0, None))[2] != (current.get(filepath) or (0, 0, None))[2])
+            self.state[directory] = current
+            if changed:
+                changes[directory] = changed
+        return changes
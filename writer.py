@@ -0,0 +1,254 @@
+"""Output layer for derivative files: only write files whose content changed, write them atomically, and remove files which are no longer generated."""
+from typing import Set, List, Tuple, Iterator, BinaryIO
+import os
+import re
+import time
+import logging
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from instrument import profiler
+
+logger = logging.getLogger(__name__)
+
+# Permissions for new files, as open() would create them. Temporary files are created private, so they are given these before being renamed.
+umask = os.umask(0)
+os.umask(umask)
+file_mode = 0o666 & ~umask
+
+# Temporary files are hidden and named after the file they replace, e.g. .tl_p001r_1.txt.k2x9_a7q.tmp, with the random part mkstemp() adds.
+temp_pattern = re.compile(r"\..+\.[a-z0-9_]{8}\.tmp")
+temp_max_age = 3600 # seconds after which remove_orphans() considers a temporary file abandoned rather than in use by another update
+
+def make_temp(directory: str, filepath: str):
+    """Create a temporary file for writing `filepath` in `directory`, named to match `temp_pattern`. Returns its file descriptor and path, as mkstemp() does."""
+    return tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(filepath)}.", suffix=".tmp")
+
+@contextlib.contextmanager
+def atomic_open(filepath: str, mode: str = "wb", **kwargs):
+    """Context manager opening a new temporary file (see make_temp()) next to `filepath`, which replaces `filepath` when the block exits.
+    Each call has a temporary file of its own, so processes writing the same file at once never write into each other's, and the last to finish wins.
+    If the block raises, the temporary file is removed and `filepath` is left untouched. Extra arguments are passed to open(), e.g. encoding.
+    """
+    directory = os.path.dirname(os.path.abspath(filepath))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = make_temp(directory, filepath)
+    try:
+        with os.fdopen(fd, mode, **kwargs) as fp:
+            yield fp
+        os.chmod(tmp_path, file_mode)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class WriteError(Exception):
+    def __init__(self, errors: List[Tuple[str, BaseException]]):
+        """Raised when one or more files could not be written. `errors` lists each file path with its exception, in the order the writes were requested."""
+        self.errors = errors
+        super().__init__(f"Failed to write {len(errors)} file{'' if len(errors)==1 else 's'}:\n" + "\n".join(f"  {path}: {error}" for path, error in errors))
+
+class OutputWriter():
+    def __init__(self, dry_run=False, workers=1):
+        """Keep track of every derivative file written during an update, with the following counts:
+            written: files created or changed
+            unchanged: files which already had the right content, and were not touched
+            removed: files which are no longer generated, and were deleted by remove_orphans()
+        If `dry_run`, files are compared as usual, but nothing is written or removed.
+        If `workers` is more than 1, files are compared and written by that many threads in the background, which helps on slow or network disks.
+        Call close() (or use the writer in a `with` statement) to wait for them; any errors are then raised together, in the order the writes were requested.
+        """
+        self.dry_run = dry_run
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.paths: Set[str] = set() # every file which is part of the output, whether written or not
+
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.pending: List[Tuple[str, Future]] = []
+        self.slots = threading.BoundedSemaphore(4 * workers) # bounds the number of queued writes, and so the content held in memory
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+            return
+        # The block is already raising: wait for pending writes, but only log their errors, so they do not replace the original exception.
+        for filepath, error in self.wait():
+            logger.error("Failed to write %s: %s", filepath, error)
+
+    def write(self, filepath: str, content: str) -> None:
+        """Write `content` to a file encoded as utf-8, unless the file already contains exactly that.
+        The new content is written to a temporary file which then replaces the old one, so the file is never left partially written.
+        """
+        self.keep(filepath)
+        if self.executor is None:
+            self.write_file(filepath, content)
+            return
+
+        self.slots.acquire()
+        future = self.executor.submit(self.write_file, filepath, content)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.pending.append((filepath, future))
+
+    def close(self) -> None:
+        """Wait for all pending writes to finish and stop the background threads; any later writes are done directly.
+        If any write failed, raise a WriteError listing them in the order they were requested.
+        """
+        errors = self.wait()
+        if errors:
+            raise WriteError(errors) from errors[0][1]
+
+    def wait(self) -> List[Tuple[str, BaseException]]:
+        """Wait for all pending writes to finish and stop the background threads. Returns the path and exception of each write which failed, in the order they were requested."""
+        if self.executor is None:
+            return []
+        self.executor.shutdown(wait=True)
+        self.executor = None
+        errors = []
+        for filepath, future in self.pending:
+            error = future.exception()
+            if error is not None:
+                errors.append((filepath, error))
+        self.pending = []
+        return errors
+
+    def write_file(self, filepath: str, content: str) -> None:
+        """Compare and write a single file. Helper function for write()."""
+        data = content.encode("utf-8")
+
+        if self.unchanged_on_disk(filepath, data):
+            with self.lock:
+                self.unchanged += 1
+            return
+
+        if self.dry_run:
+            with self.lock:
+                self.written += 1
+            return
+
+        logger.debug("Writing %s...", filepath)
+        directory = os.path.dirname(os.path.abspath(filepath))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = make_temp(directory, filepath)
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            os.chmod(tmp_path, file_mode)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with self.lock:
+            self.written += 1
+        profiler.count("files written")
+        profiler.count("bytes written", len(data))
+
+    @contextlib.contextmanager
+    def stream(self, filepath: str) -> Iterator[BinaryIO]:
+        """Context manager for writing a large file piece by piece without holding its content in memory.
+        Yields a binary file object writing to a temporary file. When the block exits, the temporary file is compared with `filepath`,
+        and replaces it if they differ; otherwise it is discarded. If the block raises, `filepath` is left untouched.
+        Streamed files are always written directly, even if the writer has workers.
+        """
+        self.keep(filepath)
+        directory = os.path.dirname(os.path.abspath(filepath))
+        if not self.dry_run:
+            os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = make_temp(None if self.dry_run else directory, filepath)
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                yield fp
+
+            if self.same_content(tmp_path, filepath):
+                with self.lock:
+                    self.unchanged += 1
+                os.remove(tmp_path)
+                return
+
+            if self.dry_run:
+                os.remove(tmp_path)
+            else:
+                logger.debug("Writing %s...", filepath)
+                size = os.path.getsize(tmp_path)
+                os.chmod(tmp_path, file_mode)
+                os.replace(tmp_path, filepath)
+                profiler.count("files written")
+                profiler.count("bytes written", size)
+            with self.lock:
+                self.written += 1
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def keep(self, filepath: str) -> None:
+        """Mark a file as part of the output without writing it, e.g. because it is known to be up to date, so remove_orphans() leaves it alone."""
+        self.paths.add(os.path.abspath(filepath))
+
+    @staticmethod
+    def unchanged_on_disk(filepath: str, data: bytes) -> bool:
+        """Return whether the file exists and contains exactly `data`."""
+        try:
+            if os.path.getsize(filepath) != len(data):
+                return False
+            with open(filepath, "rb") as fp:
+                return fp.read() == data
+        except OSError:
+            return False
+
+    @staticmethod
+    def same_content(path_a: str, path_b: str, chunk_size=1 << 16) -> bool:
+        """Return whether both files exist and have exactly the same content, reading them in chunks."""
+        try:
+            if os.path.getsize(path_a) != os.path.getsize(path_b):
+                return False
+            with open(path_a, "rb") as fp_a, open(path_b, "rb") as fp_b:
+                while True:
+                    chunk_a = fp_a.read(chunk_size)
+                    if chunk_a != fp_b.read(chunk_size):
+                        return False
+                    if not chunk_a:
+                        return True
+        except OSError:
+            return False
+
+    def remove_orphans(self, directory: str) -> None:
+        """Remove every file in `directory`, recursively, which was neither written nor kept, then any directories left empty.
+        Hidden files, such as the manifests of incremental builds, are left alone, except temporary files left behind by writes which were interrupted, e.g. by a crash.
+        Pending writes are waited for first, so none of this writer's own temporary files are still in use; those of other updates running at the same time
+        (e.g. update.py --watch next to a manual run) are only removed once they are older than `temp_max_age`.
+        """
+        self.close()
+        if not os.path.isdir(directory):
+            return
+        for root, dirs, files in os.walk(directory, topdown=False):
+            for filename in files:
+                filepath = os.path.join(root, filename)
+                if os.path.abspath(filepath) in self.paths:
+                    continue
+                if filename.startswith(".") and not (temp_pattern.fullmatch(filename) and self.abandoned(filepath)):
+                    continue
+                self.removed += 1
+                logger.debug("Removing %s...", filepath)
+                if not self.dry_run:
+                    os.remove(filepath)
+            if root != directory and not self.dry_run and not os.listdir(root):
+                os.rmdir(root)
+
+    @staticmethod
+    def abandoned(filepath: str) -> bool:
+        """Return whether a temporary file was last modified more than `temp_max_age` seconds ago."""
+        try:
+            return time.time() - os.path.getmtime(filepath) > temp_max_age
+        except OSError: # already renamed or removed by the update writing it
+            return False
+
+    def summary(self) -> str:
+        return f"{self.written} written, {self.unchanged} unchanged, {self.removed} removed"